@@ -0,0 +1,91 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+LOGGER = logging.getLogger(__name__)
+
+
+def clientToken(rowKey, payload, runId=None):
+    """
+    Derive a deterministic ClientToken for a row from its row key, payload and the run id of the journal.
+    EC2 returns the instance launched earlier when the same token is sent again, so a resumed run never
+    launches twice, while a new run with another run id launches new instances.
+    """
+    definition = {"row": str(rowKey), "payload": payload}
+    if runId is not None:
+        definition["run"] = runId
+    definition = json.dumps(definition, sort_keys=True, default=str)
+    return hashlib.sha256(definition.encode("utf-8")).hexdigest()[:64]
+
+
+def operationKey(rowKey, instanceId, operation):
+    """Key identifying one state change operation of a row in the journal"""
+    return "{}|{}|{}".format(rowKey, instanceId, str(operation).lower())
+
+
+class CheckpointJournal:
+    """
+    Local journal of completed rows, stored as one JSON object per line. Every completed row is
+    appended and flushed to disk right away, so the journal survives a failing or canceled node.
+    Rows found in the journal are skipped when the node is executed again. The run id of the
+    journal salts the client tokens of its launches, and a run without failures removes the journal
+    with `finish`, so the next execution is a new run. A journal without a path records nothing
+    and gets a new run id on every execution.
+    """
+
+    def __init__(self, path):
+        self.path = path if isinstance(path, str) and len(path) > 0 else None
+        self.entries = {}
+        self.runId = None
+        self.lock = threading.Lock()
+        if self.path is not None and os.path.exists(self.path):
+            with open(self.path, "r") as journal:
+                for line in journal:
+                    line = line.strip()
+                    if len(line) == 0:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                        if "key" in entry:
+                            self.entries[entry["key"]] = entry
+                        else:
+                            self.runId = entry["run"]
+                    except Exception as e:
+                        ## a partially written last line of an interrupted run
+                        LOGGER.warning("Ignoring unreadable checkpoint entry {}".format(str(e)))
+            LOGGER.info("Loaded {} completed rows from checkpoint {}".format(len(self.entries), self.path))
+        ## journals written before run ids keep their unsalted tokens, so their rows are still found
+        if self.runId is None and len(self.entries) == 0:
+            self.runId = uuid.uuid4().hex
+            if self.path is not None:
+                ## written right away, so a run failing before its first record is resumed with the same tokens
+                with open(self.path, "a") as journal:
+                    journal.write(json.dumps({"run": self.runId}) + "\n")
+
+    def completed(self, key):
+        """Return the journal entry of a completed row or None"""
+        return self.entries.get(key)
+
+    def record(self, key, **values):
+        """Record a completed row"""
+        entry = dict(values, key=key)
+        with self.lock:
+            self.entries[key] = entry
+            if self.path is None:
+                return
+            with open(self.path, "a") as journal:
+                journal.write(json.dumps(entry, default=str) + "\n")
+                journal.flush()
+                os.fsync(journal.fileno())
+
+    def finish(self, failed):
+        """Remove the journal after a run without failures, so the next execution starts a new run"""
+        if failed or self.path is None:
+            return
+        with self.lock:
+            self.entries = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+                LOGGER.info("Run completed without failures, removed checkpoint {}".format(self.path))
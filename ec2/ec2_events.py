@@ -0,0 +1,244 @@
+import boto3
+import json
+import logging
+import queue
+import time
+from datetime import datetime, timedelta, timezone
+import aws_metrics
+LOGGER = logging.getLogger(__name__)
+
+
+# Instance states after which an instance will not reach the running state anymore
+INSTANCE_FINAL_STATES = {"running", "stopped", "shutting-down", "terminated"}
+
+# Command invocation statuses after which a command will not change anymore
+COMMAND_FINAL_STATUSES = {"Success", "Failed", "TimedOut", "Cancelled", "Undeliverable", "Terminated", "DeliveryTimedOut", "ExecutionTimedOut"}
+
+# Seconds an event of another wait stays invisible after it was released, so it is not received again right away
+RELEASE_VISIBILITY = 30
+
+# Above this many pending commands per region the invocations are polled with one listing of all recent invocations
+# instead of one listing per command
+COMMANDS_PER_LISTING = 10
+
+
+class SqsEventSource:
+    """
+    Receives EventBridge events from an SQS queue. Set up an EventBridge rule forwarding
+    "EC2 Instance State-change Notification" and "EC2 Command Invocation Status-change Notification"
+    events to the queue. Events that belong to other waits are made visible again after
+    `releaseVisibility` seconds, so several workflows can share one queue.
+    """
+
+    def __init__(self, queueUrl, sqsClient, releaseVisibility=RELEASE_VISIBILITY):
+        self.queueUrl = queueUrl
+        self.sqsClient = sqsClient
+        self.releaseVisibility = releaseVisibility
+
+    def receive(self, waitSeconds):
+        """Long poll the queue, returning a list of (event, receipt handle, age in seconds) tuples. Unreadable events are None."""
+        resp = self.sqsClient.receive_message(QueueUrl=self.queueUrl, MaxNumberOfMessages=10, WaitTimeSeconds=int(min(20, max(0, waitSeconds))), AttributeNames=['SentTimestamp'])
+        events = []
+        for message in resp.get('Messages', []):
+            age = time.time() - int(message.get('Attributes', {}).get('SentTimestamp', time.time() * 1000)) / 1000.0
+            try:
+                body = json.loads(message['Body'])
+                ## events delivered through SNS are wrapped in a notification
+                if "Message" in body and "detail" not in body:
+                    body = json.loads(body["Message"])
+                events.append((body, message['ReceiptHandle'], age))
+            except Exception as e:
+                LOGGER.warning("Deleting unreadable event message {}".format(str(e)))
+                events.append((None, message['ReceiptHandle'], age))
+        return events
+
+    def ack(self, handle):
+        """Delete a consumed event from the queue"""
+        self.sqsClient.delete_message(QueueUrl=self.queueUrl, ReceiptHandle=handle)
+
+    def release(self, handle):
+        """Make an event of another wait visible to other consumers again, after the release visibility timeout"""
+        self.sqsClient.change_message_visibility(QueueUrl=self.queueUrl, ReceiptHandle=handle, VisibilityTimeout=self.releaseVisibility)
+
+
+class LocalEventSource:
+    """In-process stand-in for an SQS queue, events are put in with `put`. Used for testing and local runs."""
+
+    def __init__(self):
+        self.events = queue.Queue()
+
+    def put(self, event):
+        self.events.put(event)
+
+    def receive(self, waitSeconds):
+        events = []
+        try:
+            events.append((self.events.get(timeout=max(0.0, waitSeconds)), None, 0.0))
+            while True:
+                events.append((self.events.get_nowait(), None, 0.0))
+        except queue.Empty:
+            pass
+        return events
+
+    def ack(self, handle):
+        pass
+
+    def release(self, handle):
+        pass
+
+
+def instanceStateEvent(event):
+    """Return (instance id, state) of an EC2 instance state change event, otherwise None"""
+    if event.get("detail-type") != "EC2 Instance State-change Notification":
+        return None
+    detail = event.get("detail", {})
+    return detail.get("instance-id"), detail.get("state")
+
+
+def commandStatusEvent(event):
+    """Return ((command id, instance id), status) of an SSM command invocation status change event, otherwise None"""
+    if event.get("detail-type") != "EC2 Command Invocation Status-change Notification":
+        return None
+    detail = event.get("detail", {})
+    return (detail.get("command-id"), detail.get("instance-id")), detail.get("status")
+
+
+class EventWaiter:
+    """
+    Waits until a set of instances or commands reaches a final state. Without an event source it
+    polls with the fallback function every `pollInterval` seconds. With an event source it completes
+    waits as the events arrive and only calls the fallback every `fallbackInterval` seconds, to
+    catch events that were missed. Events for keys this waiter finished, unreadable events and events
+    older than the fallback interval are deleted, since every waiter has read their state by then.
+    """
+
+    def __init__(self, source=None, pollInterval=5, fallbackInterval=120, node="", region=""):
+        self.source = source
+        self.pollInterval = pollInterval
+        self.fallbackInterval = fallbackInterval
+        ## labels of the wait durations in the metrics
+        self.node = node
+        self.region = region
+
+    def wait(self, keys, parseEvent, finalValues, fallback, timeout=3600, operation="Wait"):
+        """
+        Wait for every key to reach one of the final values. `parseEvent` maps an event to a (key, value)
+        tuple or None, `fallback` maps a list of pending keys to a dictionary of their current values.
+        Returns a dictionary of key to final value, keys that timed out are missing.
+        """
+        pending = set(keys)
+        results = {}
+        started = time.time()
+        deadline = started + timeout
+        interval = self.pollInterval if self.source is None else self.fallbackInterval
+        nextFallback = time.time() + (interval if self.source is not None else 0)
+
+        while len(pending) > 0 and time.time() < deadline:
+            if time.time() >= nextFallback:
+                for key, value in fallback(list(pending)).items():
+                    if key in pending and value in finalValues:
+                        results[key] = value
+                        pending.discard(key)
+                        aws_metrics.record_wait(self.node, operation, self.region, time.time() - started)
+                nextFallback = time.time() + interval
+                continue
+
+            if self.source is None:
+                time.sleep(max(0.0, min(nextFallback, deadline) - time.time()))
+                continue
+
+            for event, handle, age in self.source.receive(min(nextFallback, deadline) - time.time()):
+                parsed = parseEvent(event) if event is not None else None
+                if parsed is None or parsed[0] not in pending:
+                    if event is None or (parsed is not None and parsed[0] in results) or age > self.fallbackInterval:
+                        ## late events of finished keys and stale events nobody waits for anymore
+                        self.source.ack(handle)
+                    else:
+                        self.source.release(handle)
+                    continue
+                self.source.ack(handle)
+                key, value = parsed
+                LOGGER.debug("Event for {}: {}".format(key, value))
+                if value in finalValues:
+                    results[key] = value
+                    pending.discard(key)
+                    aws_metrics.record_wait(self.node, operation, self.region, time.time() - started)
+
+        if len(pending) > 0:
+            LOGGER.warning("Timed out waiting for {}".format(", ".join(str(key) for key in pending)))
+        return results
+
+    def waitForInstances(self, ec2Clients, instanceIds, timeout=3600):
+        """
+        Wait until the instances are running (or stopped or terminated on the way). `ec2Clients` is one
+        client or a dictionary mapping each instance id to the client of its region. Returns instance id to state.
+        """
+        def describeStates(pendingIds):
+            byClient = {}
+            for instanceId in pendingIds:
+                client = ec2Clients[instanceId] if isinstance(ec2Clients, dict) else ec2Clients
+                byClient.setdefault(id(client), (client, []))[1].append(instanceId)
+            states = {}
+            for client, clientIds in byClient.values():
+                ## an instance-id filter skips ids that are not visible yet right after launch instead of failing
+                ## the call with InvalidInstanceID.NotFound, they stay pending until a later round
+                for start in range(0, len(clientIds), 200):
+                    try:
+                        for page in client.get_paginator('describe_instances').paginate(Filters=[{'Name': 'instance-id', 'Values': clientIds[start:start + 200]}]):
+                            for reservation in page['Reservations']:
+                                for instance in reservation['Instances']:
+                                    states[instance['InstanceId']] = instance['State']['Name']
+                    except Exception as e:
+                        LOGGER.warning("Unable to describe instances, retrying in the next round {}".format(str(e)))
+            return states
+        return self.wait(instanceIds, instanceStateEvent, INSTANCE_FINAL_STATES, describeStates, timeout, "InstanceRunning")
+
+    def waitForCommands(self, ssmClients, invocations, timeout=3600, sentAt=None):
+        """
+        Wait until the (command id, instance id) invocations are done. `ssmClients` maps each invocation to its client.
+        The invocations are polled with one listing per command, or with one listing of all invocations sent since
+        `sentAt` (seconds since the epoch, before the first command was sent) when a region has many commands, 50 invocations per call.
+        """
+        ## a minute of margin for clock skew, invocations not registered yet show up in a later round
+        sentAt = time.time() if sentAt is None else sentAt
+        invokedAfter = (datetime.fromtimestamp(sentAt, timezone.utc) - timedelta(minutes=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        def invocationStatuses(pendingInvocations):
+            byClient = {}
+            for commandId, instanceId in pendingInvocations:
+                client = ssmClients[(commandId, instanceId)]
+                byClient.setdefault(id(client), (client, set()))[1].add(commandId)
+            statuses = {}
+            for client, commandIds in byClient.values():
+                paginator = client.get_paginator('list_command_invocations')
+                if len(commandIds) > COMMANDS_PER_LISTING:
+                    listings = [{'Filters': [{'key': 'InvokedAfter', 'value': invokedAfter}]}]
+                else:
+                    listings = [{'CommandId': commandId} for commandId in commandIds]
+                for listing in listings:
+                    try:
+                        for page in paginator.paginate(**listing):
+                            for invocation in page['CommandInvocations']:
+                                statuses[(invocation['CommandId'], invocation['InstanceId'])] = invocation['Status']
+                    except Exception as e:
+                        LOGGER.warning("Unable to list command invocations {}".format(str(e)))
+            return statuses
+        return self.wait(invocations, commandStatusEvent, COMMAND_FINAL_STATUSES, invocationStatuses, timeout, "CommandDone")
+
+
+def queueRegion(queueUrl, default=None):
+    """Region of an SQS queue URL such as https://sqs.us-east-1.amazonaws.com/123456789012/queue"""
+    host = queueUrl.split("//")[-1].split("/")[0]
+    parts = host.split(".")
+    if len(parts) > 2 and parts[0] == "sqs":
+        return parts[1]
+    return default
+
+
+def eventWaiter(queueUrl, region=None, pollInterval=5, node=""):
+    """Create a waiter consuming events from the SQS queue, or a polling waiter if no queue is given"""
+    if queueUrl is None or len(queueUrl) == 0:
+        return EventWaiter(pollInterval=pollInterval, node=node, region=region)
+    LOGGER.info("Waiting for events from {}".format(queueUrl))
+    sqsClient = aws_metrics.instrument(boto3.client('sqs', region_name=queueRegion(queueUrl, region)), node)
+    return EventWaiter(SqsEventSource(queueUrl, sqsClient), pollInterval=pollInterval, node=node, region=region)
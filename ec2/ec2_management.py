@@ -1,10 +1,20 @@
+import json
 import logging
 import knime_extension as knext
 import boto3
 import pandas as pd
 from typing import List
+import aws_metrics
+import ec2_checkpoint
+import ec2_events
 import ec2_manager
+import ec2_output
+import ec2_results
+import ec2_scheduler
+import ec2_validation
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 LOGGER = logging.getLogger(__name__)
 
 
@@ -43,6 +53,14 @@ class CreateInstance(knext.PythonNode):
 
     waitUntilRunning = knext.BoolParameter("Wait until run?", "Leave checked to wait until the Instance is running to return a response. Uncheck for a faster response, but the instance may not be running.",True)
 
+    fallbackInstanceTypes = knext.StringParameter("Fallback Instance Types", "Optional comma separated list of instance types, in order of preference, to try when there is no capacity for the Instance Type.", "")
+
+    fallbackSubnets = knext.StringParameter("Fallback Subnet IDs", "Optional comma separated list of subnet IDs, for example in other availability zones, to try when there is no capacity in the Subnet.", "")
+
+    marketPreference = knext.StringParameter("Market Preference", "Launch On-Demand, Spot, or Spot with a fallback to On-Demand instances.", "on-demand", enum=ec2_scheduler.MARKET_PREFERENCES)
+
+    eventQueueUrl = knext.StringParameter("Event Queue URL", "Optional URL of an SQS queue receiving EC2 state change events from EventBridge. Waits complete as the events arrive instead of polling. Leave blank to poll.", "")
+
     def configure(self, configure_context: knext.ConfigurationContext) -> List[knext.Schema]: 
          """Configure a single table output port for Instance ID"""
          table_schema = knext.Schema.from_columns(columns=self.columns)
@@ -71,21 +89,33 @@ class CreateInstance(knext.PythonNode):
             raise ValueError("Error building payload to create EC2 Instance" +str(e))
 
         LOGGER.debug("Creating EC2 Client")
-        ec2Client = boto3.client('ec2', region_name=self.region)
+        ec2Client = aws_metrics.instrument(boto3.client('ec2', region_name=self.region), type(self).__name__)
         LOGGER.debug("Created EC2 Client. Creating EC2 Resource")
         ec2Resource = boto3.resource('ec2',region_name=self.region)
+        aws_metrics.instrument(ec2Resource.meta.client, type(self).__name__)
         LOGGER.debug("Created EC2 Resource. Creating EC2 Instance")
 
         try:
             LOGGER.debug("Trying 2")
-            resp = ec2Resource.create_instances(**payload)
-            resp2=[]
-            resp2.append(resp[0].id)
-            df['Instance ID'] = resp2
+            fallbackTypes = ec2_scheduler.parseCandidates(self.fallbackInstanceTypes)
+            fallbackSubnets = ec2_scheduler.parseCandidates(self.fallbackSubnets)
+            if len(fallbackTypes)>0 or len(fallbackSubnets)>0 or self.marketPreference != "on-demand":
+                LOGGER.info("Launching with capacity fallback")
+                payload["ClientToken"]=uuid.uuid4().hex
+                launched = ec2_scheduler.launchRow(ec2Client, payload, fallbackTypes, fallbackSubnets, self.marketPreference)
+                instance = ec2Resource.Instance(launched["instanceId"])
+            else:
+                instance = ec2Resource.create_instances(**payload)[0]
+            df['Instance ID'] = [instance.id]
             LOGGER.debug("Created EC2 instance. With Instance ID {}".format(str(df['Instance ID'])))
-            if self.waitUntilRunning == True:
+            if self.waitUntilRunning == True and len(self.eventQueueUrl) > 0:
+                LOGGER.info("Waiting for the Instance running event")
+                ec2_events.eventWaiter(self.eventQueueUrl, self.region, node=type(self).__name__).waitForInstances(ec2Client, [instance.id])
+            elif self.waitUntilRunning == True:
                 LOGGER.info("Waiting until Instance is running")
-                resp[0].wait_until_running()
+                started = time.time()
+                instance.wait_until_running()
+                aws_metrics.record_wait(type(self).__name__, "InstanceRunning", self.region, time.time() - started)
         except Exception as e:
             raise ValueError("Error creating ec2 instance" + str(e))
 
@@ -127,7 +157,7 @@ class DescribeInstances(knext.PythonNode):
     def execute(self, exec_context, input_1): 
         """Retrieve Description"""
         try:
-            ec2 = boto3.client('ec2', region_name=self.region)
+            ec2 = aws_metrics.instrument(boto3.client('ec2', region_name=self.region), type(self).__name__)
             input_1_pd = input_1.to_pandas()
             column = input_1_pd[self.instanceIds].tolist()
             result=ec2.describe_instances(InstanceIds=column)
@@ -157,100 +187,221 @@ class DescribeInstances(knext.PythonNode):
 @knext.node(name="Manage EC2 Instance(Python)", node_type=knext.NodeType.SOURCE, icon_path="icon.png", category="/")
 @knext.input_table("Instance IDs", "The table containing Instance IDs")
 @knext.output_table(name="Instance Information", description="Instance Metadata")
+@knext.output_table(name="Failed Rows", description="The rows whose operation failed, with the same columns as the Instance Information, to retry them")
 class ManageInstances(knext.PythonNode):
     ### fix description
     """
 
     This node will stop, start, restart, or terminate an instances based on the input provided. The allowed values for the Operation Performed column
     should only be "stop", "start", "restart", or "terminate"
+    Every row gets a Status, Error Code, Retryable flag and Latency. With Fail on Error unchecked all rows are processed, and the failed rows are also output on the second port.
 
 
     """
     columns = [
         knext.Column(ktype=knext.string(), name="Previous State"),
         knext.Column(ktype=knext.string(), name="Operation Perfomed"),
-        knext.Column(ktype=knext.string(), name="Response Manage Node")
+        knext.Column(ktype=knext.string(), name="Response")
 
     ]
     instanceIds= knext.ColumnParameter(label="Instance ID", description="Choose Column Containing the Instance IDs", port_index=0,include_row_key=False,include_none_column=False)
     operation= knext.ColumnParameter(label="Column Containing Start/Stop/Reboot/Terminate", description="Choose Column Containing the Operation to perform on the Instance", port_index=0,include_row_key=False,include_none_column=False)
     region = knext.StringParameter("Region", "Region to create the EC2 Instance in","us-east-1")
     failOnError = knext.BoolParameter("Fail on Error?", "Leave checked to stop operations if one instance fails.",True)
+    checkpointFile = knext.StringParameter("Checkpoint File", "Optional path of a local journal file. Completed operations are recorded in it and skipped when the node is executed again. The journal is removed once a run has no failures. Leave blank to disable.", "")
     def configure(self, configure_context: knext.ConfigurationContext, input_schema_1) -> List[knext.Schema]: 
-         """Configure a single table output port for Operation Response"""
-         table_schema = input_schema_1.append(knext.Schema.from_columns(columns=self.columns))
-         #table_schema = input_schema_1
-         #LOGGER.warning(f"Table Schema {table_schema.column}")
-         return table_schema
+         """Configure the output port for Operation Response and the port for failed rows"""
+         table_schema = ec2_results.appendSchema(input_schema_1, self.columns)
+         return table_schema, table_schema
 
 
     def execute(self, exec_context, input_1): 
         """Run EC2 Operation"""
+        journal = ec2_checkpoint.CheckpointJournal(self.checkpointFile)
+        previousStates={}
+        ec2 = aws_metrics.instrument(boto3.client('ec2', region_name=self.region), type(self).__name__)
+        input_1_pd = input_1.to_pandas()
+        rowKeys = [str(key) for key in input_1_pd.index]
+        column = input_1_pd[self.instanceIds].tolist()
+        operation_column=input_1_pd[self.operation].tolist()
         try:
-            ec2 = boto3.client('ec2', region_name=self.region)
-            input_1_pd = input_1.to_pandas()
-            column = input_1_pd[self.instanceIds].tolist()
-            operation_column=input_1_pd[self.operation].tolist()
-            result=ec2.describe_instances(InstanceIds=column)
+            pendingIds=[column[count] for count in range(len(column)) if journal.completed(ec2_checkpoint.operationKey(rowKeys[count], column[count], operation_column[count])) is None]
+            if len(pendingIds)>0:
+                result=ec2.describe_instances(InstanceIds=list(dict.fromkeys(pendingIds)))
+                for reservation in result['Reservations']:
+                    for instance in reservation['Instances']:
+                        previousStates[instance['InstanceId']]=instance['State']['Name']
         except Exception as e:
             if self.failOnError==True:
                 raise ValueError("Unable to retrieve Instance ID for an instance {}".format(str(e)))
             else:
+                ## the operations are still attempted, their previous state is unknown
                 LOGGER.error("Unable to retrieve description {}".format(str(e)))
         instance_state=[]
         performed_op=[]
         description=[]
+        results=[]
         ##To-Do: optimize this. Splice into separate arrays based on operation and pass all instances ID per operation at once
-        for count, value in enumerate(result['Reservations']):
-            instance_state.append(result['Reservations'][count]['Instances'][0]['State']['Name'])
-            #(result['Reservations'][count]['Instances'][0]['State']['Name'])
+        for count, value in enumerate(column):
+            key = ec2_checkpoint.operationKey(rowKeys[count], column[count], operation_column[count])
+            entry = journal.completed(key)
+            if entry is not None:
+                LOGGER.info("Skipping {} of instance {}, completed in a previous run".format(entry["operation"], column[count]))
+                instance_state.append(entry["previousState"])
+                performed_op.append(entry["operation"])
+                description.append(entry["response"])
+                results.append(ec2_results.RowResult.resumed())
+                continue
+
+            instance_state.append(previousStates.get(column[count], "unknown"))
+            timer = ec2_results.Timer()
             try:
                 if (str(operation_column[count])).lower() == "start":
                     LOGGER.warning(str(column[count]))
                     resp=ec2.start_instances(InstanceIds=[column[count],])
-                    performed_op.append("start")
-                    description.append(str(resp))
+                    operation, response = "start", str(resp)
                 elif (str(operation_column[count])).lower() == "stop": 
                     resp=ec2.stop_instances(InstanceIds=[column[count],])
-                    performed_op.append("stop")
-                    description.append(str(resp))
+                    operation, response = "stop", str(resp)
                 elif (str(operation_column[count])).lower() == "restart": 
                     resp=ec2.reboot_instances(InstanceIds=[column[count],])
-                    performed_op.append("restart")
-                    description.append(str(resp))
+                    operation, response = "restart", str(resp)
                 elif (str(operation_column[count])).lower() == "terminate": 
                     resp=ec2.terminate_instances(InstanceIds=[column[count],])
-                    performed_op.append("terminate")
-                    description.append(str(resp))
+                    operation, response = "terminate", str(resp)
                 else:
-                    performed_op.append("None")
-                    description.append("Already in this state")
+                    operation, response = "None", "Already in this state"
+                journal.record(key, row=rowKeys[count], instanceId=column[count], previousState=instance_state[count], operation=operation, response=response)
+                performed_op.append(operation)
+                description.append(response)
+                results.append(ec2_results.RowResult.success(timer.elapsed()))
             except Exception as e:
                 if self.failOnError==True:
                     raise ValueError("Unable to resolve operation to perform for instance: {} with error {}".format(str(column[count]), e))
                 else:
                     performed_op.append("None")
                     description.append("ERROR: Unable to perform operation")
+                    results.append(ec2_results.RowResult.failure(e, timer.elapsed()))
                     LOGGER.warning("Unable to resolve operation to perform for instance: {} with error {}".format(str(column[count]), e))
 
                     
 
 
+        input_1_pd = ec2_results.dropColumns(input_1_pd, self.columns)
         input_1_pd["Previous State"]=instance_state
         input_1_pd["Operation Perfomed"]= performed_op
         input_1_pd["Response"]= description
-        return knext.Table.from_pandas(input_1_pd)
+        journal.finish(any(result.failed for result in results))
+        ec2_results.addResults(input_1_pd, results)
+        return knext.Table.from_pandas(input_1_pd), knext.Table.from_pandas(ec2_results.failedRows(input_1_pd, results))
+
+@knext.node(name="Manage EC2 Instances by Filter(Python)", node_type=knext.NodeType.SOURCE, icon_path="icon.png", category="/")
+@knext.output_table(name="Instance Information", description="Instance Metadata")
+@knext.output_table(name="Failed Rows", description="The instances whose operation failed, with the same columns as the Instance Information, to retry them")
+class ManageInstancesByFilter(knext.PythonNode):
+    """
+
+    This node will stop, start, restart, or terminate all instances matching a filter expression in one or more regions, without a table of Instance IDs.
+    The filter expression uses the describe_instances filters described at https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#EC2.Client.describe_instances, separated by semicolons,
+    for example: tag:Environment=dev; instance-state-name=running
+    A JSON list of Filters is accepted as well. Only instances in a state the operation accepts are changed, with one call per 100 instances, for example running instances for a restart and stopped instances for a start. All others are skipped.
+
+
+    """
+    columns = [
+        knext.Column(ktype=knext.string(), name="Instance ID"),
+        knext.Column(ktype=knext.string(), name="Region"),
+        knext.Column(ktype=knext.string(), name="Previous State"),
+        knext.Column(ktype=knext.string(), name="Operation Perfomed"),
+        knext.Column(ktype=knext.string(), name="Response")
+    ]
+    regions = knext.StringParameter("Regions", "Comma separated list of the regions to select the instances in", "us-east-1")
+    filterExpression = knext.StringParameter("Filter Expression", "Filters selecting the instances, for example tag:Environment=dev; instance-state-name=running", "tag:Environment=dev")
+    operation = knext.StringParameter("Operation", "The operation to perform on all selected instances", "stop", enum=list(ec2_manager.INSTANCE_OPERATIONS))
+    failOnError = knext.BoolParameter("Fail on Error?", "Leave checked to stop operations if one instance fails.",True)
+
+    def configure(self, configure_context: knext.ConfigurationContext) -> List[knext.Schema]: 
+         """Configure the output port for Operation Response and the port for failed rows"""
+         table_schema = ec2_results.appendSchema(knext.Schema.from_columns(columns=self.columns))
+         return table_schema, table_schema
+
+
+    def manageRegion(self, region, filters):
+        """Select the instances of one region and change their state, returns one row per instance"""
+        rows = []
+        timer = ec2_results.Timer()
+        try:
+            ec2 = aws_metrics.instrument(boto3.client('ec2', region_name=region), type(self).__name__)
+            instances = ec2_manager.describeByFilter(ec2, filters)
+        except Exception as e:
+            if self.failOnError==True:
+                raise ValueError("Unable to select instances in region {} with error {}".format(region, e))
+            LOGGER.error("Unable to select instances in region {} with error {}".format(region, e))
+            return [("", region, "unknown", "None", "ERROR: Unable to select instances", ec2_results.RowResult.failure(e, timer.elapsed()))]
+        LOGGER.info("Selected {} instances in {}".format(len(instances), region))
+
+        ## the describe output is the previous state, only instances in a state the operation accepts are sent
+        _, targetState, sourceStates = ec2_manager.INSTANCE_OPERATIONS[self.operation]
+        pending = [instanceId for instanceId, state in instances if state in sourceStates]
+        timer = ec2_results.Timer()
+        responses = ec2_manager.changeInstanceStates(ec2, self.operation, pending) if len(pending) > 0 else {}
+        latency = timer.elapsed()
+
+        for instanceId, state in instances:
+            if instanceId not in responses:
+                skipped = "Already in this state" if state == targetState else "Skipped, the instance is {}".format(state)
+                rows.append((instanceId, region, state, "None", skipped, ec2_results.RowResult.success()))
+            elif isinstance(responses[instanceId], Exception):
+                if self.failOnError==True:
+                    raise ValueError("Unable to {} instance: {} with error {}".format(self.operation, instanceId, responses[instanceId]))
+                LOGGER.warning("Unable to {} instance: {} with error {}".format(self.operation, instanceId, responses[instanceId]))
+                rows.append((instanceId, region, state, "None", "ERROR: Unable to perform operation", ec2_results.RowResult.failure(responses[instanceId], latency)))
+            else:
+                rows.append((instanceId, region, state, self.operation, responses[instanceId], ec2_results.RowResult.success(latency)))
+        return rows
+
+
+    def execute(self, exec_context): 
+        """Run EC2 Operation on the selected instances"""
+        try:
+            filters = ec2_manager.parseFilters(self.filterExpression)
+        except Exception as e:
+            raise ValueError("Invalid filter expression " + str(e))
+        if len(filters) == 0:
+            raise ValueError("Enter a filter expression, an empty filter would select every instance")
+        regions = ec2_scheduler.parseCandidates(self.regions)
+
+        ## the regions are independent, select and change them at the same time
+        executor = ThreadPoolExecutor(max_workers=max(1, len(regions)))
+        try:
+            futures = [executor.submit(self.manageRegion, region, filters) for region in regions]
+            for future in as_completed(futures):
+                future.result()
+            rows = [row for future in futures for row in future.result()]
+        finally:
+            ## after a failure the regions that did not start yet are not changed anymore
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        df = pd.DataFrame({column.name: [row[index] for row in rows] for index, column in enumerate(self.columns)})
+        results = [row[-1] for row in rows]
+        ec2_results.addResults(df, results)
+        return knext.Table.from_pandas(df), knext.Table.from_pandas(ec2_results.failedRows(df, results))
 
         ## run command on ec2 instance
 
 @knext.node(name="Run Shell Command on EC2 Instance(Python)", node_type=knext.NodeType.SOURCE, icon_path="icon.png", category="/")
 @knext.input_table("Instance IDs", "The table containing the Command Details")
 @knext.output_table(name="Command Information", description="Command Metadata")
+@knext.output_table(name="Failed Rows", description="The rows whose command could not be sent or did not succeed, with the same columns as the Command Information, to retry them")
+@knext.output_table(name="Parsed Output", description="The standard output of the commands parsed into columns, with the Instance ID and Command ID of every row. Only these two columns are known before the node is executed, the parsed columns follow from the output.")
 class RunCommand(knext.PythonNode):
     ### TO DO - add additional params
     """
 
     This node will run a command on an EC2 Instance using the AWS-RunShellScript Document as described at https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ssm.html#SSM.Client.send_command and requires the instance to have the AWS SSM Agent Installed as described https://docs.aws.amazon.com/systems-manager/latest/userguide/ssm-agent.html
+    Every row gets a Status, Error Code, Retryable flag and Latency. With Fail on Error unchecked all rows are processed, and the failed rows are also output on the second port.
+    Choose an Output Format to parse the standard output of all commands into typed columns on the third port: JSON lines and CSV give one row per output line, key=value lines give one row per instance.
+    The parsed columns are known once the node has been executed. Outputs truncated by SSM are read in full from the S3 bucket.
 
 
     """
@@ -267,15 +418,23 @@ class RunCommand(knext.PythonNode):
     outputS3BucketName= knext.ColumnParameter(label="Column Containing the S3 Bucket Name", description="Choose Column Containing the S3 Bucket to Output to", port_index=0,include_row_key=False,include_none_column=False)
     failOnError = knext.BoolParameter("Fail on Error?", "Leave checked to stop operations if one command fails.",True)
     waitUntilDone = knext.BoolParameter("Wait until Command is Done?", "Leave checked to swait for the command response",True)
+    eventQueueUrl = knext.StringParameter("Event Queue URL", "Optional URL of an SQS queue receiving SSM command status change events from EventBridge. Waits complete as the events arrive instead of polling. Leave blank to poll.", "")
+    outputFormat = knext.StringParameter("Output Format", "Format of the standard output of the command to parse into the Parsed Output table. Requires waiting until the command is done.", "none", enum=ec2_output.OUTPUT_FORMATS)
+    def outputColumns(self):
+        """Columns the node appends to the input table"""
+        columns = list(self.columns)
+        if self.waitUntilDone==True:
+            columns.append(knext.Column(ktype=knext.string(), name="Output URL"))
+            columns.append(knext.Column(ktype=knext.string(), name="Standard Output Content"))
+            columns.append(knext.Column(ktype=knext.string(), name="Output"))
+        return columns
+
     def configure(self, configure_context: knext.ConfigurationContext, input_schema_1) -> List[knext.Schema]: 
-         """Configure a single table output port for Instance ID"""
-         if self.waitUntilDone==True:
-            self.columns.append(knext.Column(ktype=knext.string(), name="Output URL"))
-            self.columns.append(knext.Column(ktype=knext.string(), name="Standard Output Content"))
-            self.columns.append(knext.Column(ktype=knext.string(), name="Output"))
-    
-         table_schema = input_schema_1.append(knext.Schema.from_columns(columns=self.columns))
-         return table_schema
+         """Configure the output port for the Command Information, the port for failed rows and the port for parsed output"""
+         table_schema = ec2_results.appendSchema(input_schema_1, self.outputColumns())
+         ## the parsed columns depend on the command output, so only the key columns are declared until the node has been executed
+         parsed_schema = knext.Schema.from_columns(columns=[knext.Column(ktype=knext.string(), name=name) for name in ec2_output.KEY_COLUMNS])
+         return table_schema, table_schema, parsed_schema
 
 
     def execute(self, exec_context, input_1): 
@@ -290,10 +449,18 @@ class RunCommand(knext.PythonNode):
         outputUrl=[]
         outputContent=[]
         output=[]
+        results=[]
 
+        ssmClients={}
+        invocations={}
+        timers={}
+        sentAt=time.time()
         for count, value in enumerate(ids):
+            timers[count]=ec2_results.Timer()
             try:
-                ssm_client= boto3.client('ssm',region_name=region[count])
+                if region[count] not in ssmClients:
+                    ssmClients[region[count]]=aws_metrics.instrument(boto3.client('ssm',region_name=region[count]), type(self).__name__)
+                ssm_client=ssmClients[region[count]]
                 resp = ssm_client.send_command(
                     InstanceIds=[ids[count],],
                     DocumentName="AWS-RunShellScript",
@@ -304,46 +471,71 @@ class RunCommand(knext.PythonNode):
                 command_id = resp['Command']['CommandId']
                 commandId.append(command_id)
                 commandResponse.append(str(resp))
+                invocations[count]=(command_id, value)
+                results.append(ec2_results.RowResult.success(timers[count].elapsed()))
             except Exception as e:
                 if self.failOnError==True:
                     raise ValueError("Unable to run command on instance: {} with error {}".format(str(ids[count]), e))
                 else:
+                    results.append(ec2_results.RowResult.failure(e, timers[count].elapsed()))
                     commandId.append("Error")
-                    commandResponse.append("Unable to resolve operation to perform for instance: {} with error {}".format(str(column[count]), e))
-                    LOGGER.warning("Unable to resolve operation to perform for instance: {} with error {}".format(str(column[count]), e))
-            if self.waitUntilDone == True:
+                    commandResponse.append("Unable to resolve operation to perform for instance: {} with error {}".format(str(ids[count]), e))
+                    LOGGER.warning("Unable to resolve operation to perform for instance: {} with error {}".format(str(ids[count]), e))
+
+        if self.waitUntilDone == True:
+            ## all commands run at the same time, wait for them together and collect the outputs once they are done
+            clients={invocations[count]: ssmClients[region[count]] for count in invocations}
+            waiter=ec2_events.eventWaiter(self.eventQueueUrl, str(region[0]) if len(region)>0 else None, pollInterval=2, node=type(self).__name__)
+            waiter.waitForCommands(clients, list(clients), sentAt=sentAt)
+            for count, value in enumerate(ids):
+                if count not in invocations:
+                    outputUrl.append("Error")
+                    outputContent.append("Command was not sent")
+                    output.append("Error")
+                    continue
                 try:
-                    time.sleep(2)
-
-                    ssmoutput = ssm_client.get_command_invocation( CommandId=command_id, InstanceId=value)
-                    while ssmoutput['Status'] == "InProgress":
-                        ssmoutput = ssm_client.get_command_invocation( CommandId=command_id, InstanceId=value)
-
+                    ssmoutput = clients[invocations[count]].get_command_invocation(CommandId=invocations[count][0], InstanceId=value)
                     outputUrl.append(ssmoutput['StandardOutputUrl'])
                     outputContent.append(ssmoutput['StandardOutputContent'])
-                    output.append(str(ssmoutput))
+                    output.append(json.dumps(ssmoutput, default=str))
+                    ## a command that ran but did not succeed fails the row with its status as error code
+                    if ssmoutput['Status'] == "Success":
+                        results[count]=ec2_results.RowResult.success(timers[count].elapsed())
+                    else:
+                        results[count]=ec2_results.RowResult.failure(ssmoutput.get('StatusDetails', ssmoutput['Status']), timers[count].elapsed(), code=ssmoutput['Status'])
                 except Exception as e:
                     if self.failOnError==True:
                         raise ValueError("Unable to wait for command on instance: {} with error {}".format(str(ids[count]), e))
                     else:
+                        results[count]=ec2_results.RowResult.failure(e, timers[count].elapsed())
                         outputUrl.append("Error")
-                        outputContent.append("Unable to wait for command on instance: {} with error {}".format(str(column[count]), e))
+                        outputContent.append("Unable to wait for command on instance: {} with error {}".format(str(ids[count]), e))
                         output.append("Error")
-                        LOGGER.warning("Unable to resolve operation to perform for instance: {} with error {}".format(str(column[count]), e))
-
-
-
-
-                    
-
-
-        input_1_pd["Command ID"]=command_id
+                        LOGGER.warning("Unable to resolve operation to perform for instance: {} with error {}".format(str(ids[count]), e))
+
+
+        ## parse the outputs of all commands together, reading outputs truncated by SSM from S3
+        parsed = pd.DataFrame(columns=ec2_output.KEY_COLUMNS)
+        if self.waitUntilDone == True and self.outputFormat != "none":
+            s3Clients={}
+            contents=[]
+            collected=[count for count in invocations if outputUrl[count] != "Error"]
+            for count in collected:
+                if region[count] not in s3Clients:
+                    s3Clients[region[count]]=aws_metrics.instrument(boto3.client('s3',region_name=region[count]), type(self).__name__)
+                contents.append(ec2_output.fullOutput(s3Clients[region[count]], outputContent[count], outputUrl[count]))
+            parsed = ec2_output.parseOutputs(self.outputFormat, [ids[count] for count in collected], [invocations[count][0] for count in collected], contents)
+            LOGGER.info("Parsed {} rows from the output of {} commands".format(len(parsed), len(collected)))
+
+        input_1_pd = ec2_results.dropColumns(input_1_pd, self.outputColumns())
+        input_1_pd["Command ID"]=commandId
         input_1_pd["Command Response"]= commandResponse
         if self.waitUntilDone==True:
             input_1_pd["Output URL"]=outputUrl
             input_1_pd["Standard Output Content"]=outputContent
             input_1_pd["Output"]=output
-        return knext.Table.from_pandas(input_1_pd)
+        ec2_results.addResults(input_1_pd, results)
+        return knext.Table.from_pandas(input_1_pd), knext.Table.from_pandas(ec2_results.failedRows(input_1_pd, results)), knext.Table.from_pandas(parsed)
 
 
 ## create instances table input
@@ -351,6 +543,7 @@ class RunCommand(knext.PythonNode):
 @knext.node(name="Create EC2 Instance Table Input (Python)", node_type=knext.NodeType.SOURCE, icon_path="icon.png", category="/")
 @knext.input_table("Instance Data", "The table containing the Instance Details")
 @knext.output_table(name="Instance Information", description="Instance Metadata")
+@knext.output_table(name="Failed Rows", description="The rows that could not be launched, with the same columns as the Instance Information, to retry them")
 class CreateInstanceTable(knext.PythonNode):
     ### fix description
     """
@@ -360,6 +553,7 @@ class CreateInstanceTable(knext.PythonNode):
     You can add additional parameters in the Additional Parameters as a JSON String that follow the format outlined at https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#EC2.ServiceResource.create_instances. 
     As an example, if you would like to customize the Block Device Settings, you would put the following into the additional Parameters:
     {"TagSpecifications": [{"ResourceType": "instance","Tags": [{"Key": "Name","Value": "EC2fromKNIME"}]}],"IamInstanceProfile": {"Name": "iamName"},"SecurityGroupIds": ["sg-id"]}
+    Every row gets a Status, Error Code, Retryable flag and Latency. With Fail on Error unchecked all rows are processed, and the failed rows are also output on the second port.
 
 
     """
@@ -387,10 +581,26 @@ class CreateInstanceTable(knext.PythonNode):
 
     failOnError = knext.BoolParameter("Fail on Error?", "Leave checked to abort the node if an Instance fails to create running to return a response.",True)
 
+    validateBeforeLaunch = knext.BoolParameter("Validate before launch?", "Leave checked to check the images, subnets, security groups and key pairs of all rows before any instance is launched. Invalid rows are reported before anything is launched.",True)
+
+    dryRunChecks = knext.BoolParameter("Dry run checks?", "Check every row with a DryRun launch in parallel before launching. This also catches permission and quota errors, at the cost of one additional call per row.",False)
+
+    checkpointFile = knext.StringParameter("Checkpoint File", "Optional path of a local journal file. Launched instances are recorded in it and their rows are skipped when the node is executed again, so a failed run can be resumed without launching instances twice. The journal is removed once a run has no failures, and the next execution launches new instances. Leave blank to disable.", "")
+
+    instanceTypeCandidates = knext.ColumnParameter(label="Fallback Instance Types Column", description="Optionally choose a column containing a ranked list of instance types (JSON list or comma separated) to try when there is no capacity for the Instance Type", port_index=0,include_row_key=False,include_none_column=True)
+
+    subnetCandidates = knext.ColumnParameter(label="Fallback Subnets Column", description="Optionally choose a column containing a ranked list of subnet IDs (JSON list or comma separated) to try when there is no capacity in the Subnet", port_index=0,include_row_key=False,include_none_column=True)
+
+    marketPreference = knext.StringParameter("Market Preference", "Launch On-Demand, Spot, or Spot with a fallback to On-Demand instances.", "on-demand", enum=ec2_scheduler.MARKET_PREFERENCES)
+
+    maxConcurrentLaunches = knext.IntParameter("Concurrent Launches", "Maximum number of rows launched at the same time when launching with capacity fallback.", 10, min_value=1, max_value=100)
+
+    eventQueueUrl = knext.StringParameter("Event Queue URL", "Optional URL of an SQS queue receiving EC2 state change events from EventBridge. Waits complete as the events arrive instead of polling. Leave blank to poll.", "")
+
     def configure(self, configure_context: knext.ConfigurationContext, input_schema_1) -> List[knext.Schema]: 
-         """Configure a single table output port for Instance ID"""
-         table_schema = input_schema_1.append(knext.Schema.from_columns(columns=self.columns))
-         return table_schema
+         """Configure the output port for the Instance IDs and the port for failed rows"""
+         table_schema = ec2_results.appendSchema(input_schema_1, self.columns)
+         return table_schema, table_schema
 
 
     def execute(self, exec_context, input_1): 
@@ -401,6 +611,7 @@ class CreateInstanceTable(knext.PythonNode):
 
 
         input_1_pd = input_1.to_pandas()
+        rowKeys = [str(key) for key in input_1_pd.index]
         regions = input_1_pd[self.region].tolist()
         images=input_1_pd[self.image].tolist()
         instanceTypes=input_1_pd[self.instanceType].tolist()
@@ -411,10 +622,15 @@ class CreateInstanceTable(knext.PythonNode):
         keyNames=input_1_pd[self.keyName].tolist()
         instanceIds=[]
         instanceResponses=[]
+        results=[]
 
+        ## build the payloads of all rows before launching anything
+        payloads={}
+        invalidRows={}
+        invalidCodes={}
         for count, value in enumerate(regions):
             try:
-                payload=ec2_manager.ec2Payload(additionalParams=additionalParamss[count],
+                payloads[count]=ec2_manager.ec2Payload(additionalParams=additionalParamss[count],
                     ImageId=images[count],
                     InstanceType=instanceTypes[count],
                     MinCount=1,
@@ -423,45 +639,244 @@ class CreateInstanceTable(knext.PythonNode):
                     SecurityGroupIds=securityGroupIDs[count],
                     KeyName=keyNames[count],
                     SubnetId=subnets[count])
-
-
+            except Exception as e:
+                invalidRows[count]=["Error building payload to create EC2 Instance " +str(e)]
+                invalidCodes[count]="InvalidPayload"
+
+        ## a ClientToken per row and run makes launches idempotent within the run, rows in the journal are already done
+        journal = ec2_checkpoint.CheckpointJournal(self.checkpointFile)
+        completedRows={}
+        for count, payload in payloads.items():
+            if "ClientToken" not in payload:
+                payload["ClientToken"]=ec2_checkpoint.clientToken(rowKeys[count], payload, journal.runId)
+            entry = journal.completed(payload["ClientToken"])
+            if entry is not None:
+                completedRows[count]=entry
+        if len(completedRows)>0:
+            LOGGER.info("Resuming from checkpoint, skipping {} rows launched before".format(len(completedRows)))
+
+        LOGGER.debug("Creating EC2 Clients")
+        ec2Clients={region: aws_metrics.instrument(boto3.client('ec2', region_name=region), type(self).__name__) for region in set(regions[count] for count in payloads)}
+
+        ## pre-flight checks of the referenced resources
+        if self.validateBeforeLaunch == True:
+            LOGGER.info("Validating {} instance definitions before launch".format(len(payloads)))
+            validPayloads={count: payload for count, payload in payloads.items() if count not in invalidRows and count not in completedRows}
+            invalidRows.update(ec2_validation.validatePayloads(ec2Clients, regions, validPayloads, dryRun=self.dryRunChecks))
+
+        if len(invalidRows)>0 and self.failOnError==True:
+            messages=["Row {}: {}".format(rowKeys[count], "; ".join(invalidRows[count])) for count in sorted(invalidRows)]
+            raise ValueError("{} of {} rows are invalid, no instance was created.\n{}".format(len(invalidRows), len(regions), "\n".join(messages)))
+
+        ## capacity aware launches run concurrently, each row falls back across its ranked candidates
+        typeCandidates = ec2_manager.optionalColumn(input_1_pd, self.instanceTypeCandidates)
+        subnetCandidates = ec2_manager.optionalColumn(input_1_pd, self.subnetCandidates)
+        scheduled={}
+        launchedInstances={}
+        if self.instanceTypeCandidates not in ec2_manager.NONE_COLUMNS or self.subnetCandidates not in ec2_manager.NONE_COLUMNS or self.marketPreference != "on-demand":
+            pendingRows=[count for count in payloads if count not in invalidRows and count not in completedRows]
+            candidates={count: ec2_scheduler.launchCandidates(payloads[count], ec2_scheduler.parseCandidates(typeCandidates[count]),
+                ec2_scheduler.parseCandidates(subnetCandidates[count]), self.marketPreference) for count in pendingRows}
+            ## rows launched before under any of their candidates keep that instance
+            for region in set(regions[count] for count in pendingRows):
+                found = ec2_scheduler.launchedBefore(ec2Clients[region], {count: (payloads[count], candidates[count]) for count in pendingRows if regions[count] == region})
+                for count, launched in found.items():
+                    launched["latency"] = 0.0
+                    scheduled[count] = launched
+                    launchedInstances[launched["instanceId"]] = ec2Clients[region]
+                    journal.record(payloads[count]["ClientToken"], row=rowKeys[count], instanceId=launched["instanceId"], response=launched["response"])
+            pendingRows=[count for count in pendingRows if count not in scheduled]
+            LOGGER.info("Launching {} rows with capacity fallback".format(len(pendingRows)))
+            def launchTimed(count):
+                timer = ec2_results.Timer()
                 try:
-                    LOGGER.debug("Creating EC2 Client")
-                    ec2Client = boto3.client('ec2', region_name=regions[count])
-                    LOGGER.debug("Created EC2 Client. Creating EC2 Resource")
-                    ec2Resource = boto3.resource('ec2',region_name=regions[count])
-                    LOGGER.debug("Created EC2 Resource. Creating EC2 Instance")
-                    resp = ec2Resource.create_instances(**payload)
-                    instanceIds.append(resp[0].id)
-                    instanceResponses.append(str(resp))
-
-                    LOGGER.debug("Created EC2 instance. With Instance ID {}".format(str(instanceIds[count])))
-                    if self.waitUntilRunning == True:
-                        LOGGER.info("Waiting until Instance is running")
-                        resp[0].wait_until_running()
+                    launched = ec2_scheduler.launchRow(ec2Clients[regions[count]], payloads[count],
+                        ec2_scheduler.parseCandidates(typeCandidates[count]), ec2_scheduler.parseCandidates(subnetCandidates[count]), self.marketPreference)
                 except Exception as e:
-                    if self.failOnError==True:
-                        raise ValueError(("Error creating ec2 instance " + str(e)))
-                    else:
-                        LOGGER.warning(("Error creating ec2 instance " + str(e)))
-                        instanceIds[count]="ERROR"
-                        instanceResponses[count]=("Error creating ec2 instance " + str(e))
-
+                    e.latency = timer.elapsed()
+                    raise
+                launched["latency"] = timer.elapsed()
+                return launched
+            with ThreadPoolExecutor(max_workers=self.maxConcurrentLaunches) as executor:
+                futures={count: executor.submit(launchTimed, count) for count in pendingRows}
+                for count, future in futures.items():
+                    try:
+                        scheduled[count]=future.result()
+                        launchedInstances[scheduled[count]["instanceId"]]=ec2Clients[regions[count]]
+                        journal.record(payloads[count]["ClientToken"], row=rowKeys[count], instanceId=scheduled[count]["instanceId"], response=scheduled[count]["response"])
+                    except Exception as e:
+                        scheduled[count]=e
 
+        for count, value in enumerate(regions):
+            if count in invalidRows:
+                LOGGER.warning("Skipping invalid row {}: {}".format(rowKeys[count], "; ".join(invalidRows[count])))
+                instanceIds.append("ERROR")
+                instanceResponses.append("; ".join(invalidRows[count]))
+                results.append(ec2_results.RowResult.failure("; ".join(invalidRows[count]), code=invalidCodes.get(count, "ValidationFailed")))
+                continue
+
+            if count in completedRows:
+                instanceIds.append(completedRows[count]["instanceId"])
+                instanceResponses.append(completedRows[count]["response"])
+                results.append(ec2_results.RowResult.resumed())
+                continue
+
+            if count in scheduled:
+                if isinstance(scheduled[count], Exception):
+                    if self.failOnError==True:
+                        raise ValueError(("Error creating ec2 instance " + str(scheduled[count])))
+                    LOGGER.warning(("Error creating ec2 instance " + str(scheduled[count])))
+                    instanceIds.append("ERROR")
+                    instanceResponses.append("Error creating ec2 instance " + str(scheduled[count]))
+                    results.append(ec2_results.RowResult.failure(scheduled[count], getattr(scheduled[count], "latency", 0.0)))
+                else:
+                    instanceIds.append(scheduled[count]["instanceId"])
+                    instanceResponses.append(scheduled[count]["response"])
+                    results.append(ec2_results.RowResult.success(scheduled[count]["latency"]))
+                continue
 
+            timer = ec2_results.Timer()
+            try:
+                LOGGER.debug("Creating EC2 Resource")
+                ec2Resource = boto3.resource('ec2',region_name=regions[count])
+                aws_metrics.instrument(ec2Resource.meta.client, type(self).__name__)
+                LOGGER.debug("Created EC2 Resource. Creating EC2 Instance")
+                resp = ec2Resource.create_instances(**payloads[count])
+                instanceIds.append(resp[0].id)
+                instanceResponses.append(str(resp))
+                results.append(ec2_results.RowResult.success(timer.elapsed()))
+                journal.record(payloads[count]["ClientToken"], row=rowKeys[count], instanceId=resp[0].id, response=str(resp))
+
+                LOGGER.debug("Created EC2 instance. With Instance ID {}".format(str(instanceIds[count])))
+                if self.waitUntilRunning == True:
+                    ## all rows are launched first and waited for together below
+                    launchedInstances[resp[0].id]=ec2Clients[regions[count]]
             except Exception as e:
                 if self.failOnError==True:
-                        raise ValueError("Error building payload to create EC2 Instance " +str(e))
+                    raise ValueError(("Error creating ec2 instance " + str(e)))
                 else:
-                    LOGGER.warning("Error building payload to create EC2 Instance " +str(e))
-                    instanceIds[count]="ERROR"
-                    instanceResponses[count]=("Error building payload to create EC2 Instance " +str(e))
+                    LOGGER.warning(("Error creating ec2 instance " + str(e)))
+                    if len(instanceIds) > count:
+                        ## the instance was created, but waiting for it failed
+                        instanceResponses[count]=("Error creating ec2 instance " + str(e))
+                        results[count]=ec2_results.RowResult.failure(e, timer.elapsed())
+                    else:
+                        instanceIds.append("ERROR")
+                        instanceResponses.append("Error creating ec2 instance " + str(e))
+                        results.append(ec2_results.RowResult.failure(e, timer.elapsed()))
+
+        ## wait for all instances launched without waiting, with events or one batched describe per poll
+        if self.waitUntilRunning == True and len(launchedInstances)>0:
+            LOGGER.info("Waiting until {} Instances are running".format(len(launchedInstances)))
+            states = ec2_events.eventWaiter(self.eventQueueUrl, regions[0], node=type(self).__name__).waitForInstances(launchedInstances, list(launchedInstances))
+            for count, instanceId in enumerate(instanceIds):
+                if instanceId not in launchedInstances or states.get(instanceId) == "running":
+                    continue
+                state = states.get(instanceId, "pending")
+                LOGGER.warning("Instance {} is {} instead of running".format(instanceId, state))
+                results[count]=ec2_results.RowResult.failure("Instance {} is {} instead of running".format(instanceId, state), results[count].latency, code="InstanceNotRunning")
+
+        input_1_pd = ec2_results.dropColumns(input_1_pd, self.columns)
+        input_1_pd["Instance IDs"]=instanceIds
+        input_1_pd["Response"]=instanceResponses
+        journal.finish(any(result.failed for result in results))
+        ec2_results.addResults(input_1_pd, results)
+        return knext.Table.from_pandas(input_1_pd), knext.Table.from_pandas(ec2_results.failedRows(input_1_pd, results))
 
+        ## run any allow-listed ec2 operation on a table
 
+@knext.node(name="EC2 API Executor(Python)", node_type=knext.NodeType.SOURCE, icon_path="icon.png", category="/")
+@knext.input_table("Operation Parameters", "The table containing the parameters of each call")
+@knext.output_table(name="Operation Information", description="The response of the operation for every row")
+@knext.output_table(name="Failed Rows", description="The rows whose operation failed, with the same columns as the Operation Information, to retry them")
+class ApiExecutor(knext.PythonNode):
+    """
 
+    This node will run one EC2 operation, such as create_snapshot, attach_volume, create_tags or describe_images, for every row of the input table
+    using the client methods described at https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#client
+    Columns named like a parameter of the operation, for example VolumeId or InstanceId, set that parameter. A JSON column adds further parameters, for example {"Tags": [{"Key": "Team", "Value": "data"}]}.
+    All rows are validated before the first call. Rows that only differ in the ID list of operations such as create_tags or stop_instances are sent in one call per 100 IDs,
+    describe operations are paginated and return all items, and the calls run concurrently.
 
 
+    """
+    columns = [
+        knext.Column(ktype=knext.string(), name="Operation Perfomed"),
+        knext.Column(ktype=knext.string(), name="Response")
+    ]
+    operation = knext.StringParameter("Operation", "The EC2 client method to call for every row", "describe_instances", enum=sorted(ec2_manager.API_OPERATIONS))
+    region = knext.StringParameter("Region", "Region to call the operation in, for rows without a value in the region column", "us-east-1")
+    regionColumn = knext.ColumnParameter(label="Column Containing the Region", description="Optionally choose a column containing the region of each row", port_index=0,include_row_key=False,include_none_column=True)
+    parametersColumn = knext.ColumnParameter(label="Column Containing the Parameters", description="Optionally choose a column containing further parameters of each row as JSON, they take precedence over columns named like a parameter", port_index=0,include_row_key=False,include_none_column=True)
+    maxWorkers = knext.IntParameter("Concurrent Calls", "Number of calls to run at the same time", 10, min_value=1, max_value=50)
+    failOnError = knext.BoolParameter("Fail on Error?", "Leave checked to stop operations if one row fails.",True)
 
-        input_1_pd["Instance IDs"]=instanceIds
-        input_1_pd["Response"]=instanceResponses
-        return knext.Table.from_pandas(input_1_pd)
\ No newline at end of file
+    def configure(self, configure_context: knext.ConfigurationContext, input_schema_1) -> List[knext.Schema]: 
+         """Configure the output port for the Operation Response and the port for failed rows"""
+         table_schema = ec2_results.appendSchema(input_schema_1, self.columns)
+         return table_schema, table_schema
+
+
+    def execute(self, exec_context, input_1): 
+        """Run the EC2 Operation on every row"""
+        input_1_pd = input_1.to_pandas()
+        rowKeys = [str(key) for key in input_1_pd.index]
+        ## the result columns of a fed back failed rows table are not parameters of the call
+        records = ec2_results.dropColumns(input_1_pd, self.columns).to_dict("records")
+        regions = [self.region if ec2_manager.isMissing(value) else str(value) for value in ec2_manager.optionalColumn(input_1_pd, self.regionColumn)]
+        parameters = ec2_manager.optionalColumn(input_1_pd, self.parametersColumn)
+        clients = {region: aws_metrics.instrument(boto3.client('ec2', region_name=region), type(self).__name__) for region in set(regions)}
+        responses = [""] * len(records)
+        results = [None] * len(records)
+
+        ## assemble and validate every row before the first call
+        rowParams = {}
+        for count in range(len(records)):
+            try:
+                rowParams[count] = ec2_manager.apiParameters(clients[regions[count]], self.operation, records[count], parameters[count])
+            except Exception as e:
+                if self.failOnError==True:
+                    raise ValueError("Invalid parameters in row {}: {}".format(rowKeys[count], e))
+                LOGGER.warning("Invalid parameters in row {}: {}".format(rowKeys[count], e))
+                responses[count] = "ERROR: Invalid parameters"
+                results[count] = ec2_results.RowResult.failure(e, code="InvalidParameters")
+
+        batchParameter = ec2_manager.API_OPERATIONS[self.operation].get("batch")
+
+        def runGroup(group):
+            region, params, rows = group
+            timer = ec2_results.Timer()
+            if batchParameter is not None:
+                groupResponses = ec2_manager.groupedCalls(getattr(clients[region], self.operation), batchParameter, params, rows)
+            else:
+                try:
+                    groupResponses = {rows[0][0]: ec2_manager.callOperation(clients[region], self.operation, params)}
+                except Exception as e:
+                    groupResponses = {rows[0][0]: e}
+            return groupResponses, timer.elapsed()
+
+        groups = ec2_manager.groupRows(self.operation, rowParams, regions)
+        LOGGER.info("Running {} on {} rows with {} calls".format(self.operation, len(rowParams), len(groups)))
+        executor = ThreadPoolExecutor(max_workers=self.maxWorkers)
+        try:
+            for future in as_completed([executor.submit(runGroup, group) for group in groups]):
+                groupResponses, latency = future.result()
+                for count, resp in groupResponses.items():
+                    if isinstance(resp, Exception):
+                        if self.failOnError==True:
+                            raise ValueError("Unable to run {} for row {} with error {}".format(self.operation, rowKeys[count], resp))
+                        LOGGER.warning("Unable to run {} for row {} with error {}".format(self.operation, rowKeys[count], resp))
+                        responses[count] = "ERROR: Unable to perform operation"
+                        results[count] = ec2_results.RowResult.failure(resp, latency)
+                    else:
+                        responses[count] = json.dumps({key: value for key, value in resp.items() if key != 'ResponseMetadata'}, default=str)
+                        results[count] = ec2_results.RowResult.success(latency)
+        finally:
+            ## after a failure the calls that did not start yet are cancelled, only the running ones complete
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        input_1_pd = ec2_results.dropColumns(input_1_pd, self.columns)
+        input_1_pd["Operation Perfomed"] = [self.operation if result.status == ec2_results.SUCCESS else "None" for result in results]
+        input_1_pd["Response"] = responses
+        ec2_results.addResults(input_1_pd, results)
+        return knext.Table.from_pandas(input_1_pd), knext.Table.from_pandas(ec2_results.failedRows(input_1_pd, results))
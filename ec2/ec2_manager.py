@@ -1,7 +1,11 @@
 import json
 import logging
+import pandas as pd
+from botocore.validate import validate_parameters
 LOGGER = logging.getLogger(__name__)
 
+# Values of an optional column parameter when no column is selected
+NONE_COLUMNS = (None, "", "<none>")
 
 
 createInstanceDict=dict(
@@ -283,4 +287,259 @@ def ec2Payload(additionalParams, **kwargs):
     dictionary.update(additionalParams)
     LOGGER.debug("Succesfully added Additional Paramaters to EC2 Instance Payload")
     return dictionary
-                
\ No newline at end of file
+                
+
+
+def optionalColumn(df, column):
+    """Return the values of an optional column as list, or a list of None if no column is selected"""
+    if column in NONE_COLUMNS:
+        return [None] * len(df)
+    return df[column].tolist()
+
+
+# Instance state change operations, with the client method, the state the instances end up in and the states
+# the operation accepts. Instances in other states would fail the whole bulk call.
+INSTANCE_OPERATIONS = {
+    "start": ("start_instances", "running", {"stopped"}),
+    "stop": ("stop_instances", "stopped", {"pending", "running"}),
+    "restart": ("reboot_instances", None, {"running"}),
+    "terminate": ("terminate_instances", "terminated", {"pending", "running", "stopping", "stopped"}),
+}
+
+# Maximum number of instance IDs sent in one state change call
+BULK_CHUNK_SIZE = 100
+
+
+def chunks(values, size=BULK_CHUNK_SIZE):
+    """Split a list into consecutive chunks of at most size values"""
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def parseFilters(expression):
+    """
+    Parse a filter expression into describe_instances Filters. The expression is either a JSON list of
+    Filters or terms separated by ; such as "tag:Environment=dev; instance-state-name=running,stopped"
+    """
+    expression = expression.strip() if isinstance(expression, str) else ""
+    if expression.startswith("["):
+        return json.loads(expression)
+    filters = []
+    for term in expression.split(";"):
+        if len(term.strip()) == 0:
+            continue
+        if "=" not in term:
+            raise ValueError("Filter term {} is not in the format name=value1,value2".format(term.strip()))
+        name, values = term.split("=", 1)
+        filters.append({"Name": name.strip(), "Values": [value.strip() for value in values.split(",") if len(value.strip()) > 0]})
+    return filters
+
+
+def describeByFilter(ec2Client, filters):
+    """Return (instance id, state) of every instance matching the filters, with a paginated describe"""
+    instances = []
+    for page in ec2Client.get_paginator('describe_instances').paginate(Filters=filters, PaginationConfig={'PageSize': 1000}):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                instances.append((instance['InstanceId'], instance['State']['Name']))
+    return instances
+
+
+def changeInstanceStates(ec2Client, operation, instanceIds):
+    """
+    Run a state change operation on many instances with one call per chunk. When a chunk fails, its
+    instances are retried one by one so a single bad instance does not fail the others.
+    Returns a dictionary of instance id to the response or the exception of the instance.
+    """
+    method = getattr(ec2Client, INSTANCE_OPERATIONS[operation][0])
+    responses = {}
+    for instanceId, resp in groupedCalls(method, "InstanceIds", {}, [(instanceId, [instanceId]) for instanceId in instanceIds]).items():
+        if isinstance(resp, Exception):
+            responses[instanceId] = resp
+            continue
+        ## start, stop and terminate report every instance, reboot only returns the request metadata
+        changes = {change['InstanceId']: change for key in ('StartingInstances', 'StoppingInstances', 'TerminatingInstances') for change in resp.get(key, [])}
+        responses[instanceId] = str(changes.get(instanceId, resp))
+    return responses
+
+
+# Operations of the EC2 API Executor node. Rows of operations with a "batch" parameter that only differ in that
+# ID list are sent in one call, operations with a "list" key are paginated and collect that key of every page.
+API_OPERATIONS = {
+    "describe_instances": {"list": "Reservations"},
+    "describe_instance_status": {"list": "InstanceStatuses"},
+    "describe_volumes": {"list": "Volumes"},
+    "describe_snapshots": {"list": "Snapshots"},
+    "describe_images": {"list": "Images"},
+    "describe_tags": {"list": "Tags"},
+    "start_instances": {"batch": "InstanceIds"},
+    "stop_instances": {"batch": "InstanceIds"},
+    "reboot_instances": {"batch": "InstanceIds"},
+    "terminate_instances": {"batch": "InstanceIds"},
+    "monitor_instances": {"batch": "InstanceIds"},
+    "unmonitor_instances": {"batch": "InstanceIds"},
+    "create_tags": {"batch": "Resources"},
+    "delete_tags": {"batch": "Resources"},
+    "modify_instance_attribute": {},
+    "create_volume": {},
+    "attach_volume": {},
+    "detach_volume": {},
+    "delete_volume": {},
+    "modify_volume": {},
+    "create_snapshot": {},
+    "copy_snapshot": {},
+    "delete_snapshot": {},
+    "create_image": {},
+    "copy_image": {},
+    "deregister_image": {},
+}
+
+
+def isMissing(value):
+    """True for empty cells, including the missing values of nullable columns, which don't set a parameter"""
+    if isinstance(value, str):
+        return len(value.strip()) == 0
+    return pd.api.types.is_scalar(value) and bool(pd.isna(value))
+
+
+def parameterValue(value, shape):
+    """Convert a cell into the type of an API parameter. Lists and structures can be given as JSON, lists also comma separated."""
+    if hasattr(value, "item"):
+        ## numpy scalars of pandas columns
+        value = value.item()
+    if shape.type_name in ("list", "structure", "map"):
+        if isinstance(value, str):
+            text = value.strip()
+            if text.startswith("[") or text.startswith("{"):
+                return json.loads(text)
+            if shape.type_name == "list":
+                return [item.strip() for item in text.split(",") if len(item.strip()) > 0]
+        if shape.type_name == "list" and not isinstance(value, (list, tuple)):
+            return [value]
+        return value
+    if shape.type_name in ("integer", "long"):
+        return int(value)
+    if shape.type_name in ("float", "double"):
+        return float(value)
+    if shape.type_name == "boolean":
+        return value if isinstance(value, bool) else str(value).strip().lower() in ("true", "1", "yes")
+    if shape.type_name == "string":
+        return str(value)
+    return value
+
+
+def apiParameters(ec2Client, operation, row, parametersJson=None):
+    """
+    Assemble and validate the parameters of one row of the EC2 API Executor. Columns named like a parameter of the
+    operation set that parameter, the JSON of the parameters column adds further parameters and takes precedence.
+    The parameters are validated against the service model, so invalid rows fail before anything is called.
+    """
+    if operation not in API_OPERATIONS:
+        raise ValueError("Operation {} is not supported".format(operation))
+    operationModel = ec2Client.meta.service_model.operation_model(ec2Client.meta.method_to_api_mapping[operation])
+    members = operationModel.input_shape.members if operationModel.input_shape is not None else {}
+
+    params = {}
+    for name, value in row.items():
+        if name in members and not isMissing(value):
+            params[name] = parameterValue(value, members[name])
+    if not isMissing(parametersJson):
+        params.update(convertJSONtoDict(jsonString=str(parametersJson)))
+
+    unknown = [name for name in params if name not in members]
+    if len(unknown) > 0:
+        raise ValueError("Unknown parameters for {}: {}".format(operation, ", ".join(unknown)))
+    if operationModel.input_shape is not None:
+        validate_parameters(params, operationModel.input_shape)
+    return params
+
+
+def groupRows(operation, rowParams, regions):
+    """
+    Group the rows of a batch operation that are sent in one call, rows of the same region that share all parameters
+    but the ID list. Returns a list of (region, shared parameters, [(row, ids)]). Other operations get one group per row.
+    """
+    idParameter = API_OPERATIONS[operation].get("batch")
+    if idParameter is None:
+        return [(regions[row], params, [(row, None)]) for row, params in rowParams.items()]
+    groups = {}
+    for row, params in rowParams.items():
+        shared = {name: value for name, value in params.items() if name != idParameter}
+        key = (regions[row], json.dumps(shared, sort_keys=True, default=str))
+        groups.setdefault(key, (regions[row], shared, []))[2].append((row, list(params.get(idParameter, []))))
+    return list(groups.values())
+
+
+def rowResponse(resp, ids):
+    """The part of a batch response that belongs to the IDs of one row, list entries that name other IDs are dropped"""
+    ids = set(ids)
+    filtered = {}
+    for key, value in resp.items():
+        if isinstance(value, list):
+            value = [entry for entry in value if not isinstance(entry, dict) or any(field in ids for field in entry.values() if isinstance(field, str))]
+        filtered[key] = value
+    return filtered
+
+
+def groupedCalls(method, idParameter, params, rows, size=BULK_CHUNK_SIZE):
+    """
+    Call a batch operation for several rows that share all parameters but the ID list, concatenating the IDs of the rows
+    into one call per chunk of at most `size` IDs. Rows with more IDs are split over several calls. When a call fails,
+    its parts are retried one by one so a single bad ID does not fail the other rows. `rows` is a list of (row, ids),
+    returns a dictionary of row to its part of the responses, or the first exception of the row.
+    """
+    pieces = []
+    rowPieces = {}
+    for row, ids in rows:
+        for start in range(0, max(1, len(ids)), size):
+            rowPieces.setdefault(row, []).append(len(pieces))
+            pieces.append(ids[start:start + size])
+
+    chunks = []
+    for index, ids in enumerate(pieces):
+        if len(chunks) == 0 or sum(len(pieces[other]) for other in chunks[-1]) + len(ids) > size:
+            chunks.append([])
+        chunks[-1].append(index)
+
+    pieceResponses = {}
+    for chunk in chunks:
+        try:
+            resp = method(**dict(params, **{idParameter: [i for index in chunk for i in pieces[index]]}))
+            for index in chunk:
+                pieceResponses[index] = resp
+        except Exception as e:
+            if len(chunk) == 1:
+                pieceResponses[chunk[0]] = e
+                continue
+            LOGGER.warning("Call for {} rows failed, retrying one by one {}".format(len(chunk), str(e)))
+            for index in chunk:
+                try:
+                    pieceResponses[index] = method(**dict(params, **{idParameter: pieces[index]}))
+                except Exception as pieceError:
+                    pieceResponses[index] = pieceError
+
+    responses = {}
+    for row, ids in rows:
+        merged = {}
+        for index in rowPieces[row]:
+            resp = pieceResponses[index]
+            if isinstance(resp, Exception):
+                merged = resp
+                break
+            for key, value in rowResponse(resp, ids).items():
+                merged[key] = merged[key] + value if isinstance(value, list) and isinstance(merged.get(key), list) else value
+        responses[row] = merged
+    return responses
+
+
+def callOperation(ec2Client, operation, params):
+    """Call an operation for one row. List operations are paginated and return all items under their list key."""
+    listKey = API_OPERATIONS[operation].get("list")
+    if listKey is None:
+        return getattr(ec2Client, operation)(**params)
+    if not ec2Client.can_paginate(operation):
+        return {listKey: getattr(ec2Client, operation)(**params).get(listKey, [])}
+    items = []
+    for page in ec2Client.get_paginator(operation).paginate(**params):
+        items.extend(page.get(listKey, []))
+    return {listKey: items}
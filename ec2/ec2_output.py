@@ -0,0 +1,163 @@
+import io
+import json
+import logging
+from urllib.parse import unquote, urlparse
+import pandas as pd
+LOGGER = logging.getLogger(__name__)
+
+
+# Formats of the standard output of a command that can be parsed into columns
+OUTPUT_FORMATS = ["none", "json lines", "csv", "key=value"]
+
+# SSM truncates the standard output returned by get_command_invocation to this many characters
+MAX_INLINE_OUTPUT = 24000
+
+# Columns identifying the command invocation of a parsed row
+KEY_COLUMNS = ["Instance ID", "Command ID"]
+
+
+def s3Location(outputUrl):
+    """Bucket and key of a StandardOutputUrl such as https://s3.us-east-1.amazonaws.com/bucket/prefix/stdout"""
+    path = unquote(urlparse(outputUrl).path).lstrip("/")
+    bucket, key = path.split("/", 1)
+    return bucket, key
+
+
+def fullOutput(s3Client, content, outputUrl):
+    """The complete standard output, read from S3 when the inline content was truncated"""
+    if len(content) < MAX_INLINE_OUTPUT or not outputUrl:
+        return content
+    try:
+        bucket, key = s3Location(outputUrl)
+        return s3Client.get_object(Bucket=bucket, Key=key)['Body'].read().decode("utf-8", errors="replace")
+    except Exception as e:
+        LOGGER.warning("Unable to read the full output from {}, parsing the truncated output {}".format(outputUrl, str(e)))
+        return content
+
+
+def jsonRecords(content):
+    """Records of a JSON document, or of one JSON object per line"""
+    try:
+        document = json.loads(content)
+        return document if isinstance(document, list) else [document]
+    except ValueError:
+        pass
+    records = []
+    for line in content.splitlines():
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            LOGGER.debug("Skipping line that is not JSON: {}".format(line[:200]))
+    return records
+
+
+def keyValueRecord(content):
+    """One record of the key=value lines of an output, other lines are ignored"""
+    record = {}
+    for line in content.splitlines():
+        if "=" in line:
+            key, value = line.split("=", 1)
+            if len(key.strip()) > 0:
+                record[key.strip()] = value.strip()
+    return record
+
+
+def withKeys(df, keys):
+    """Insert the key columns in front of the parsed columns, output fields with the same names get an Output prefix"""
+    df = df.rename(columns={name: "Output " + name for name in KEY_COLUMNS if name in df.columns})
+    df.insert(0, "Command ID", [key[1] for key in keys])
+    df.insert(0, "Instance ID", [key[0] for key in keys])
+    return df
+
+
+def parseJsonLines(keys, contents):
+    rows = []
+    for key, content in zip(keys, contents):
+        for record in jsonRecords(content):
+            rows.append((key, record if isinstance(record, dict) else {"Value": record}))
+    if len(rows) == 0:
+        return pd.DataFrame(columns=KEY_COLUMNS)
+    ## one normalize call for all instances flattens nested objects into dotted column names
+    df = pd.json_normalize([record for _, record in rows])
+    return withKeys(df, [key for key, _ in rows])
+
+
+def parseCsv(keys, contents):
+    ## outputs with the same header are concatenated and read with a single read_csv call
+    groups = {}
+    for key, content in zip(keys, contents):
+        lines = [line for line in content.splitlines() if len(line.strip()) > 0]
+        if len(lines) < 2:
+            continue
+        group = groups.setdefault(lines[0], ([], []))
+        group[0].extend([key] * (len(lines) - 1))
+        group[1].extend(lines[1:])
+    frames = []
+    for header, (rowKeys, lines) in groups.items():
+        df = pd.read_csv(io.StringIO("\n".join([header] + lines)), skipinitialspace=True)
+        if len(df) != len(rowKeys):
+            LOGGER.warning("Skipping CSV output with header {}, its rows could not be matched to the instances".format(header))
+            continue
+        frames.append(withKeys(df, rowKeys))
+    if len(frames) == 0:
+        return pd.DataFrame(columns=KEY_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+
+def parseKeyValue(keys, contents):
+    records = [keyValueRecord(content) for content in contents]
+    df = pd.DataFrame(records, index=range(len(records)))
+    return withKeys(df, keys)
+
+
+def typedColumns(df):
+    """
+    Convert columns of text or mixed values into boolean, numeric or string columns. Each column is
+    converted as a whole, its type is inferred once and only lists and objects are serialized per value.
+    """
+    for column in df.columns[len(KEY_COLUMNS):]:
+        values = df[column]
+        if values.dtype != object:
+            continue
+        present = values.dropna()
+        kind = pd.api.types.infer_dtype(present, skipna=True)
+        if kind == "boolean":
+            df[column] = values.astype("boolean")
+            continue
+        if kind in ("integer", "floating", "mixed-integer-float", "decimal"):
+            df[column] = pd.to_numeric(values, errors="coerce")
+            continue
+        if kind == "string" and len(present) > 0:
+            if present.str.strip().str.lower().isin(["true", "false"]).all():
+                df[column] = values.str.strip().str.lower().map({"true": True, "false": False}).astype("boolean")
+                continue
+            if pd.to_numeric(present, errors="coerce").notna().all():
+                df[column] = pd.to_numeric(values, errors="coerce")
+                continue
+        elif kind not in ("string", "empty"):
+            ## lists and objects of JSON records are kept as JSON text
+            values = values.map(lambda v: json.dumps(v) if isinstance(v, (list, dict)) else v, na_action="ignore")
+        df[column] = values.astype("string")
+    return df
+
+
+def parseOutputs(outputFormat, instanceIds, commandIds, contents):
+    """
+    Parse the standard outputs of many command invocations into one table with typed columns. JSON lines and
+    CSV outputs give one row per line, key=value outputs one row per instance. Every row starts with the
+    Instance ID and Command ID it came from.
+    """
+    keys = list(zip(instanceIds, commandIds))
+    if outputFormat == "json lines":
+        df = parseJsonLines(keys, contents)
+    elif outputFormat == "csv":
+        df = parseCsv(keys, contents)
+    elif outputFormat == "key=value":
+        df = parseKeyValue(keys, contents)
+    else:
+        raise ValueError("Unknown output format {}".format(outputFormat))
+    df.columns = [str(column) for column in df.columns]
+    return typedColumns(df.reset_index(drop=True))
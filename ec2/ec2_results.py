@@ -0,0 +1,125 @@
+import logging
+import time
+import knime_extension as knext
+from botocore.exceptions import ClientError
+LOGGER = logging.getLogger(__name__)
+
+
+# Row statuses
+SUCCESS = "SUCCESS"
+ERROR = "ERROR"
+RESUMED = "RESUMED"
+
+# Error codes that are likely to succeed when the row is retried later
+RETRYABLE_CODES = {
+    "RequestLimitExceeded",
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "InternalError",
+    "InternalFailure",
+    "InternalServerError",
+    "ServiceUnavailable",
+    "Unavailable",
+    "InsufficientInstanceCapacity",
+    "InsufficientCapacity",
+    "InsufficientHostCapacity",
+    "CapacityError",
+    "InvocationDoesNotExist",
+    "DeliveryTimedOut",
+    "Undeliverable",
+    "EndpointConnectionError",
+    "ConnectTimeoutError",
+    "ReadTimeoutError",
+}
+
+# Columns appended to the output table of every batch node
+columns = [
+    knext.Column(ktype=knext.string(), name="Status"),
+    knext.Column(ktype=knext.string(), name="Error Code"),
+    knext.Column(ktype=knext.string(), name="Error Message"),
+    knext.Column(ktype=knext.bool_(), name="Retryable"),
+    knext.Column(ktype=knext.double(), name="Latency (ms)")
+]
+
+
+def errorCode(e):
+    """Error code of an exception, the AWS error code for service errors and the exception type otherwise"""
+    if isinstance(e, ClientError):
+        return e.response['Error']['Code']
+    return type(e).__name__
+
+
+class RowResult:
+    """Outcome of the processing of one input row"""
+
+    def __init__(self, status=SUCCESS, code="", message="", retryable=False, latency=0.0):
+        self.status = status
+        self.code = code
+        self.message = message
+        self.retryable = retryable
+        self.latency = latency
+
+    @classmethod
+    def success(cls, latency=0.0):
+        return cls(SUCCESS, latency=latency)
+
+    @classmethod
+    def resumed(cls):
+        return cls(RESUMED)
+
+    @classmethod
+    def failure(cls, e, latency=0.0, code=None):
+        """Result of a row that failed with the exception or message `e`"""
+        code = code if code is not None else errorCode(e) if isinstance(e, Exception) else "Error"
+        return cls(ERROR, code, str(e), code in RETRYABLE_CODES, latency)
+
+    @property
+    def failed(self):
+        return self.status == ERROR
+
+
+class Timer:
+    """Measures the latency of the work done for a row, in milliseconds"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+
+    def elapsed(self):
+        return (time.perf_counter() - self.start) * 1000.0
+
+
+def appendSchema(input_schema, nodeColumns=()):
+    """
+    Schema of a batch output table, the input columns followed by the columns
+    of the node and the result columns. Input columns with the name of an
+    appended column are dropped, so the failed rows can be fed back in.
+    """
+    appended = list(nodeColumns) + columns
+    names = {column.name for column in appended}
+    kept = [column for column in input_schema if column.name not in names]
+    return knext.Schema.from_columns(columns=kept + appended)
+
+
+def dropColumns(df, nodeColumns=()):
+    """Drop the columns of the node and the result columns a fed back input already has, matching appendSchema"""
+    names = [column.name for column in list(nodeColumns) + columns]
+    return df.drop(columns=[name for name in names if name in df.columns])
+
+
+def addResults(df, results):
+    """Append the result columns to the output DataFrame, one result per row"""
+    df["Status"] = [result.status for result in results]
+    df["Error Code"] = [result.code for result in results]
+    df["Error Message"] = [result.message for result in results]
+    df["Retryable"] = [result.retryable for result in results]
+    df["Latency (ms)"] = [float(result.latency) for result in results]
+    return df
+
+
+def failedRows(df, results):
+    """The rows of the output DataFrame that failed, for retrying them"""
+    failed = [result.failed for result in results]
+    if any(failed):
+        LOGGER.warning("{} of {} rows failed".format(sum(failed), len(results)))
+    return df[failed]
@@ -0,0 +1,230 @@
+import hashlib
+import json
+import logging
+from botocore.exceptions import ClientError
+LOGGER = logging.getLogger(__name__)
+
+
+# Market preferences of the launch scheduler
+MARKET_PREFERENCES = ["on-demand", "spot", "spot-then-on-demand"]
+
+# Error codes after which the next candidate is tried instead of failing the row
+CAPACITY_ERRORS = {
+    "InsufficientInstanceCapacity",
+    "InsufficientCapacity",
+    "InsufficientHostCapacity",
+    "InsufficientReservedInstanceCapacity",
+    "InsufficientFreeAddressesInSubnet",
+    "Unsupported",
+    "SpotMaxPriceTooLow",
+    "MaxSpotInstanceCountExceeded",
+}
+
+
+# States of instances that a row launched in an earlier run still owns
+LIVE_STATES = ["pending", "running", "stopping", "stopped"]
+
+# Tag with the row token on instances launched by an EC2 Fleet, whose instances carry client tokens of the fleet
+LAUNCH_TOKEN_TAG = "knime:launch-token"
+
+# Payload fields an instant EC2 Fleet can carry, rows with other fields are launched with run_instances
+FLEET_FIELDS = {"LaunchTemplate", "ImageId", "InstanceType", "SubnetId", "Placement", "InstanceMarketOptions", "TagSpecifications", "ClientToken", "MinCount", "MaxCount"}
+
+
+class CapacityError(Exception):
+    """Raised when none of the candidates of a row could be launched"""
+
+
+def parseCandidates(value):
+    """Parse a ranked list of candidates given as JSON list or comma separated string"""
+    if value is None or (isinstance(value, float) and value != value):
+        return []
+    if isinstance(value, (list, tuple)):
+        return [str(v).strip() for v in value if len(str(v).strip()) > 0]
+    value = str(value).strip()
+    if value.startswith("["):
+        return [str(v).strip() for v in json.loads(value) if len(str(v).strip()) > 0]
+    return [v.strip() for v in value.split(",") if len(v.strip()) > 0]
+
+
+def marketTypes(preference):
+    """Market types to try in order for a market preference"""
+    if preference == "spot":
+        return ["spot"]
+    if preference == "spot-then-on-demand":
+        return ["spot", "on-demand"]
+    return ["on-demand"]
+
+
+def launchCandidates(payload, instanceTypes, subnets, preference):
+    """
+    Ranked list of (instance type, subnet, market type) candidates for a row. The instance type and subnet
+    of the payload come first, followed by the ranked alternatives. All instance types are tried in a subnet
+    before moving on to the next subnet, and on-demand is only tried after all spot candidates.
+    """
+    types = list(dict.fromkeys([t for t in [payload.get("InstanceType")] + list(instanceTypes) if t]))
+    subnetIds = list(dict.fromkeys([s for s in [payload.get("SubnetId")] + list(subnets) if s]))
+    if len(subnetIds) == 0:
+        subnetIds = [None]
+    return [(instanceType, subnetId, market) for market in marketTypes(preference) for subnetId in subnetIds for instanceType in types]
+
+
+def rowToken(payload):
+    """Token of a row, its ClientToken or a hash of the payload"""
+    return payload.get("ClientToken", hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:64])
+
+
+def candidateToken(payload, candidate):
+    """ClientToken of one candidate, derived from the row token so reruns stay idempotent per candidate"""
+    return hashlib.sha256("{}|{}|{}|{}".format(rowToken(payload), *candidate).encode("utf-8")).hexdigest()[:64]
+
+
+def candidatePayload(payload, candidate):
+    """Payload of the row with the instance type, subnet and market type of a candidate"""
+    instanceType, subnetId, market = candidate
+    candidatePayload = dict(payload)
+    candidatePayload["InstanceType"] = instanceType
+    if subnetId is not None:
+        candidatePayload["SubnetId"] = subnetId
+    if market == "spot":
+        ## keep the spot options of the row, such as MaxPrice
+        candidatePayload["InstanceMarketOptions"] = dict(payload.get("InstanceMarketOptions", {}), MarketType="spot")
+    else:
+        candidatePayload.pop("InstanceMarketOptions", None)
+    candidatePayload["ClientToken"] = candidateToken(payload, candidate)
+    return candidatePayload
+
+
+def launchWithFallback(ec2Client, payload, candidates):
+    """Launch the first candidate that has capacity, trying them in ranked order"""
+    attempts = []
+    for candidate in candidates:
+        try:
+            resp = ec2Client.run_instances(**candidatePayload(payload, candidate))
+            LOGGER.info("Launched {} as {} in {} ({})".format(resp['Instances'][0]['InstanceId'], *candidate))
+            return {"instanceId": resp['Instances'][0]['InstanceId'], "candidate": candidate, "response": str(resp), "attempts": attempts}
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code not in CAPACITY_ERRORS:
+                raise
+            LOGGER.warning("No capacity for {} in {} ({}): {}".format(candidate[0], candidate[1], candidate[2], code))
+            attempts.append("{}/{}/{}: {}".format(candidate[0], candidate[1], candidate[2], code))
+    raise CapacityError("No capacity for any candidate: " + "; ".join(attempts))
+
+
+def fleetUnsupported(payload):
+    """Fields of a payload that an instant EC2 Fleet can't carry"""
+    unsupported = sorted(set(payload) - FLEET_FIELDS)
+    spotOptions = payload.get("InstanceMarketOptions", {}).get("SpotOptions", {})
+    if len(set(spotOptions) - {"MaxPrice"}) > 0:
+        unsupported.append("InstanceMarketOptions")
+    return unsupported
+
+
+def launchWithFleet(ec2Client, payload, candidates):
+    """
+    Launch one instance with an instant EC2 Fleet, letting EC2 pick the highest ranked candidate with capacity.
+    Requires a LaunchTemplate in the payload and no fields beyond FLEET_FIELDS, one fleet request is sent per market type.
+    The instance is tagged with the row token, so an earlier launch is found again by `launchedBefore`.
+    """
+    template = dict(payload["LaunchTemplate"])
+    template.setdefault("Version", "$Default")
+    maxPrice = payload.get("InstanceMarketOptions", {}).get("SpotOptions", {}).get("MaxPrice")
+    tagSpecifications = [dict(spec) for spec in payload.get("TagSpecifications", [])]
+    instanceTags = [spec for spec in tagSpecifications if spec.get("ResourceType") == "instance"]
+    if len(instanceTags) == 0:
+        instanceTags = [{"ResourceType": "instance", "Tags": []}]
+        tagSpecifications.extend(instanceTags)
+    instanceTags[0]["Tags"] = list(instanceTags[0].get("Tags", [])) + [{"Key": LAUNCH_TOKEN_TAG, "Value": rowToken(payload)}]
+    attempts = []
+    for market in dict.fromkeys(candidate[2] for candidate in candidates):
+        overrides = []
+        for priority, (instanceType, subnetId, candidateMarket) in enumerate(candidates):
+            if candidateMarket != market:
+                continue
+            override = {"InstanceType": instanceType, "Priority": float(priority)}
+            if subnetId is not None:
+                override["SubnetId"] = subnetId
+            if payload.get("ImageId"):
+                override["ImageId"] = payload["ImageId"]
+            if payload.get("Placement"):
+                override["Placement"] = payload["Placement"]
+            if maxPrice is not None and market == "spot":
+                override["MaxPrice"] = maxPrice
+            overrides.append(override)
+
+        request = dict(
+            Type="instant",
+            LaunchTemplateConfigs=[{"LaunchTemplateSpecification": template, "Overrides": overrides}],
+            TargetCapacitySpecification={"TotalTargetCapacity": 1, "DefaultTargetCapacityType": market},
+            SpotOptions={"AllocationStrategy": "capacity-optimized-prioritized"},
+            OnDemandOptions={"AllocationStrategy": "prioritized"},
+            ClientToken=candidateToken(payload, ("fleet", market, len(overrides))),
+            TagSpecifications=tagSpecifications,
+        )
+
+        resp = ec2Client.create_fleet(**request)
+        for instances in resp.get("Instances", []):
+            if len(instances.get("InstanceIds", [])) > 0:
+                overridesUsed = instances.get("LaunchTemplateAndOverrides", {}).get("Overrides", {})
+                candidate = (overridesUsed.get("InstanceType"), overridesUsed.get("SubnetId"), market)
+                LOGGER.info("Fleet launched {} as {} in {} ({})".format(instances["InstanceIds"][0], *candidate))
+                return {"instanceId": instances["InstanceIds"][0], "candidate": candidate, "response": str(resp), "attempts": attempts}
+        attempts.extend("{}: {}".format(market, error.get("ErrorCode")) for error in resp.get("Errors", []))
+    raise CapacityError("Fleet found no capacity for any candidate: " + "; ".join(attempts))
+
+
+def usesFleet(payload, useFleet=True, warn=True):
+    """True if a row is launched with an EC2 Fleet, rows with fields the fleet can't carry use run_instances with their launch template"""
+    if not useFleet or "LaunchTemplate" not in payload:
+        return False
+    unsupported = fleetUnsupported(payload)
+    if len(unsupported) > 0:
+        if warn:
+            LOGGER.warning("Launching without EC2 Fleet, it can't carry {} of the row, set them in the launch template to use the fleet".format(", ".join(unsupported)))
+        return False
+    return True
+
+
+def launchRow(ec2Client, payload, instanceTypes=(), subnets=(), preference="on-demand", useFleet=True):
+    """
+    Launch one instance for a row, falling back across the ranked instance types, subnets and market types.
+    Rows with a LaunchTemplate use an instant EC2 Fleet, all others try the candidates one after another.
+    """
+    candidates = launchCandidates(payload, instanceTypes, subnets, preference)
+    if usesFleet(payload, useFleet):
+        return launchWithFleet(ec2Client, payload, candidates)
+    return launchWithFallback(ec2Client, payload, candidates)
+
+
+def launchedBefore(ec2Client, rows, useFleet=True, chunkSize=200):
+    """
+    Find the instances that rows launched in an earlier run, by the client tokens of their candidates or by the launch
+    token tag of fleet launches. Each candidate has its own client token, so without this lookup a rerun where a higher
+    ranked candidate has capacity again would launch a second instance. `rows` maps a key to (payload, candidates).
+    Returns a dictionary of key to the launch result of the instance found, terminated instances are ignored.
+    """
+    byToken = {}
+    byTag = {}
+    for key, (payload, candidates) in rows.items():
+        if usesFleet(payload, useFleet, warn=False):
+            byTag[rowToken(payload)] = key
+        else:
+            byToken.update({candidateToken(payload, candidate): key for candidate in candidates})
+
+    found = {}
+    for filterName, keys in (("client-token", byToken), ("tag:" + LAUNCH_TOKEN_TAG, byTag)):
+        tokens = list(keys)
+        for start in range(0, len(tokens), chunkSize):
+            filters = [{"Name": filterName, "Values": tokens[start:start + chunkSize]}, {"Name": "instance-state-name", "Values": LIVE_STATES}]
+            for page in ec2Client.get_paginator('describe_instances').paginate(Filters=filters):
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+                        key = keys.get(tags.get(LAUNCH_TOKEN_TAG) if filterName != "client-token" else instance.get('ClientToken'))
+                        if key is None or key in found:
+                            continue
+                        candidate = (instance.get('InstanceType'), instance.get('SubnetId'), "spot" if instance.get('InstanceLifecycle') == "spot" else "on-demand")
+                        LOGGER.info("Row was launched before as {}".format(instance['InstanceId']))
+                        found[key] = {"instanceId": instance['InstanceId'], "candidate": candidate, "response": str(instance), "attempts": []}
+    return found
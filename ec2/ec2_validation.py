@@ -0,0 +1,134 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+LOGGER = logging.getLogger(__name__)
+
+
+# Maximum number of values the EC2 describe calls accept in one filter
+FILTER_CHUNK_SIZE = 200
+
+# Resources checked before launching, as
+# (payload key, describe operation, result key, filter name, attribute of the described resource)
+RESOURCE_CHECKS = [
+    ("ImageId", "describe_images", "Images", "image-id", "ImageId"),
+    ("SubnetId", "describe_subnets", "Subnets", "subnet-id", "SubnetId"),
+    ("SecurityGroupIds", "describe_security_groups", "SecurityGroups", "group-id", "GroupId"),
+    ("SecurityGroups", "describe_security_groups", "SecurityGroups", "group-name", "GroupName"),
+    ("KeyName", "describe_key_pairs", "KeyPairs", "key-name", "KeyName"),
+]
+
+
+def payloadValues(payload, key):
+    """Return the values of a payload entry as a list, whether it holds one value or a list"""
+    value = payload.get(key)
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [v for v in value if isinstance(v, str) and len(v) > 0]
+    if isinstance(value, str) and len(value) > 0:
+        return [value]
+    return []
+
+
+def collectResources(regions, payloads):
+    """Collect the distinct resources referenced by the payloads, per region and payload key"""
+    resources = {}
+    for count, payload in payloads.items():
+        regionResources = resources.setdefault(regions[count], {})
+        for check in RESOURCE_CHECKS:
+            regionResources.setdefault(check[0], set()).update(payloadValues(payload, check[0]))
+    return resources
+
+
+def describeResources(ec2Client, operation, resultKey, filterName, values):
+    """Describe all resources matching the values with as few calls as possible. Unknown values are simply not returned."""
+    described = []
+    values = sorted(values)
+    for start in range(0, len(values), FILTER_CHUNK_SIZE):
+        filters = [{'Name': filterName, 'Values': values[start:start + FILTER_CHUNK_SIZE]}]
+        if ec2Client.can_paginate(operation):
+            for page in ec2Client.get_paginator(operation).paginate(Filters=filters):
+                described.extend(page.get(resultKey, []))
+        else:
+            described.extend(getattr(ec2Client, operation)(Filters=filters).get(resultKey, []))
+    return described
+
+
+def describeRegion(ec2Client, regionResources):
+    """
+    Describe the referenced resources of one region. Returns the found values per payload key
+    and the VPC of every found subnet and security group.
+    """
+    found = {}
+    vpcs = {}
+    for (key, operation, resultKey, filterName, attribute) in RESOURCE_CHECKS:
+        values = regionResources.get(key, set())
+        if len(values) == 0:
+            found[key] = set()
+            continue
+        described = describeResources(ec2Client, operation, resultKey, filterName, values)
+        found[key] = set(item[attribute] for item in described)
+        for item in described:
+            if "VpcId" in item:
+                vpcs[item[attribute]] = item["VpcId"]
+    return found, vpcs
+
+
+def dryRunInstance(ec2Client, payload):
+    """Run a DryRun launch of the payload. Returns None if the launch would succeed, otherwise the error message."""
+    try:
+        ec2Client.run_instances(DryRun=True, **payload)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'DryRunOperation':
+            return None
+        return "Dry run failed: {} ({})".format(e.response['Error']['Message'], e.response['Error']['Code'])
+    except Exception as e:
+        return "Dry run failed: " + str(e)
+    return None
+
+
+def validatePayloads(ec2Clients, regions, payloads, dryRun=False, maxWorkers=10):
+    """
+    Validate the instance payloads of a table before anything is launched. The distinct
+    images, subnets, security groups and key pairs of all payloads are described with a
+    few batched calls per region, and optionally every payload is checked with a DryRun
+    launch. Returns a dictionary of row index to a list of error messages for invalid rows.
+    """
+    errors = {}
+    resources = collectResources(regions, payloads)
+
+    with ThreadPoolExecutor(max_workers=max(1, maxWorkers)) as executor:
+        futures = {region: executor.submit(describeRegion, ec2Clients[region], regionResources) for region, regionResources in resources.items()}
+        described = {}
+        for region, future in futures.items():
+            try:
+                described[region] = future.result()
+            except Exception as e:
+                LOGGER.warning("Unable to validate resources in region {}: {}".format(region, str(e)))
+                for count in payloads:
+                    if regions[count] == region:
+                        errors.setdefault(count, []).append("Unable to validate resources in region {}: {}".format(region, str(e)))
+
+        for count, payload in payloads.items():
+            if regions[count] not in described:
+                continue
+            found, vpcs = described[regions[count]]
+            for check in RESOURCE_CHECKS:
+                for value in payloadValues(payload, check[0]):
+                    if value not in found[check[0]]:
+                        errors.setdefault(count, []).append("{} {} not found in region {}".format(check[0], value, regions[count]))
+
+            subnetVpc = vpcs.get(payload.get("SubnetId"))
+            for groupId in payloadValues(payload, "SecurityGroupIds"):
+                if subnetVpc is not None and groupId in vpcs and vpcs[groupId] != subnetVpc:
+                    errors.setdefault(count, []).append("Security group {} is not in the VPC {} of subnet {}".format(groupId, subnetVpc, payload.get("SubnetId")))
+
+        if dryRun:
+            dryRunFutures = {count: executor.submit(dryRunInstance, ec2Clients[regions[count]], payload) for count, payload in payloads.items() if count not in errors}
+            for count, future in dryRunFutures.items():
+                message = future.result()
+                if message is not None:
+                    errors.setdefault(count, []).append(message)
+
+    LOGGER.info("Validated {} instance definitions, {} invalid".format(len(payloads), len(errors)))
+    return errors
@@ -0,0 +1,268 @@
+"""
+Optional metrics of the AWS calls made by the nodes, exported in the
+Prometheus text format. Set KNIME_AWS_METRICS_DIR to write the metrics to a
+.prom file in that directory, for the textfile collector of the node
+exporter, and/or KNIME_AWS_METRICS_PORT to serve them on
+http://localhost:<port>/metrics. The endpoint only listens on the loopback
+interface unless KNIME_AWS_METRICS_BIND sets another address. Without either
+variable nothing is recorded.
+
+The ec2 and rekognition extensions each ship a copy of this module, keep the
+two files identical.
+"""
+
+import atexit
+import http.server
+import logging
+import os
+import threading
+import time
+import weakref
+from typing import Dict, Optional, Tuple
+
+LOGGER = logging.getLogger(__name__)
+
+METRICS_DIR_ENV = "KNIME_AWS_METRICS_DIR"
+METRICS_PORT_ENV = "KNIME_AWS_METRICS_PORT"
+METRICS_INTERVAL_ENV = "KNIME_AWS_METRICS_INTERVAL"
+METRICS_BIND_ENV = "KNIME_AWS_METRICS_BIND"
+DEFAULT_BIND = "127.0.0.1"
+
+# Histogram buckets in seconds, for API calls and for waits on jobs and instances
+CALL_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+WAIT_BUCKETS = (1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0)
+
+# Response keys counted as detected faces
+FACE_KEYS = ("FaceDetails", "FaceRecords", "Faces")
+
+METRICS = {
+    "knime_aws_api_calls_total": ("counter", "AWS API calls by node, operation and region"),
+    "knime_aws_api_errors_total": ("counter", "AWS API calls that failed, by error code"),
+    "knime_aws_api_retries_total": ("counter", "Retries of AWS API calls reported by botocore"),
+    "knime_aws_api_call_duration_seconds": ("histogram", "Duration of AWS API calls including retries"),
+    "knime_aws_bytes_sent_total": ("counter", "Bytes sent in AWS API requests"),
+    "knime_aws_bytes_received_total": ("counter", "Bytes received in AWS API responses"),
+    "knime_aws_wait_duration_seconds": ("histogram", "Time spent waiting for jobs, instances and commands"),
+    "knime_aws_instances_launched_total": ("counter", "EC2 instances launched"),
+    "knime_aws_faces_detected_total": ("counter", "Faces detected or indexed by Rekognition"),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Registry:
+    """Thread safe store of labeled counters and histograms"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, list]] = {}
+        self.buckets: Dict[str, tuple] = {}
+
+    def inc(self, name: str, labels: Labels, value: float = 1.0):
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0.0) + value
+
+    def observe(self, name: str, labels: Labels, value: float, buckets: tuple):
+        with self.lock:
+            self.buckets[name] = buckets
+            series = self.histograms.setdefault(name, {})
+            # one count per bucket, followed by the sum and the total count
+            counts = series.setdefault(labels, [0] * len(buckets) + [0.0, 0])
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+
+        lines = []
+        with self.lock:
+            for name, (kind, description) in METRICS.items():
+                if name not in self.counters and name not in self.histograms:
+                    continue
+                lines.append("# HELP {0} {1}".format(name, description))
+                lines.append("# TYPE {0} {1}".format(name, kind))
+                for labels, value in sorted(self.counters.get(name, {}).items()):
+                    lines.append("{0}{1} {2}".format(name, format_labels(labels), repr(float(value))))
+                for labels, counts in sorted(self.histograms.get(name, {}).items()):
+                    cumulative = 0
+                    for bound, count in zip(self.buckets[name], counts):
+                        cumulative += count
+                        lines.append("{0}_bucket{1} {2}".format(name, format_labels(labels + (("le", repr(bound)),)), cumulative))
+                    lines.append("{0}_bucket{1} {2}".format(name, format_labels(labels + (("le", "+Inf"),)), counts[-1]))
+                    lines.append("{0}_sum{1} {2}".format(name, format_labels(labels), repr(float(counts[-2]))))
+                    lines.append("{0}_count{1} {2}".format(name, format_labels(labels), counts[-1]))
+        return "\n".join(lines) + "\n"
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(labels: Labels) -> str:
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join("{0}=\"{1}\"".format(name, escape(value)) for name, value in labels) + "}"
+
+
+def write_textfile(registry: Registry, directory: str):
+    """Atomically replace the metrics file of this process, so the collector never reads a partial file"""
+
+    path = os.path.join(directory, "knime_aws_{0}.prom".format(os.getpid()))
+    try:
+        with open(path + ".tmp", "w") as metrics_file:
+            metrics_file.write(registry.render())
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        LOGGER.warning("Unable to write metrics to {0}: {1}".format(path, e))
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOGGER.debug(format % args)
+
+
+def start(directory: str, port: str, interval: float, bind: str = DEFAULT_BIND) -> Registry:
+    registry = Registry()
+    if directory:
+        def flush():
+            while True:
+                time.sleep(interval)
+                write_textfile(registry, directory)
+        threading.Thread(target=flush, name="metrics-textfile", daemon=True).start()
+        atexit.register(write_textfile, registry, directory)
+        LOGGER.info("Writing metrics to {0} every {1} seconds".format(directory, interval))
+    if port:
+        try:
+            server = http.server.ThreadingHTTPServer((bind, int(port)), MetricsHandler)
+            server.daemon_threads = True
+            server.registry = registry
+            threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+            LOGGER.info("Serving metrics on {0}:{1}".format(bind, port))
+        except (OSError, ValueError) as e:
+            # another KNIME process already serves its metrics on this port
+            LOGGER.warning("Unable to serve metrics on port {0}: {1}".format(port, e))
+    return registry
+
+
+_registry: Optional[Registry] = None
+_initialized = False
+_init_lock = threading.Lock()
+_nodes = weakref.WeakKeyDictionary()
+
+
+def registry() -> Optional[Registry]:
+    """The registry of this process, created on first use, or None if metrics are disabled"""
+
+    global _registry, _initialized
+    if not _initialized:
+        with _init_lock:
+            if not _initialized:
+                directory = os.environ.get(METRICS_DIR_ENV, "")
+                port = os.environ.get(METRICS_PORT_ENV, "")
+                if directory or port:
+                    _registry = start(directory, port, float(os.environ.get(METRICS_INTERVAL_ENV, "15")), os.environ.get(METRICS_BIND_ENV, DEFAULT_BIND))
+                _initialized = True
+    return _registry
+
+
+def instrument(client, node: str):
+    """
+    Record the calls of a boto3 client under the name of the node. The
+    hooks are registered once per client, so clients can be shared. Returns
+    the client.
+    """
+
+    metrics = registry()
+    if metrics is None:
+        return client
+    try:
+        _nodes[client] = node
+    except TypeError:
+        pass
+    service = client.meta.service_model.service_name
+    region = client.meta.region_name or ""
+
+    def labels(event_name: str) -> Labels:
+        return (("node", node), ("operation", event_name.split(".")[-1]), ("region", region), ("service", service))
+
+    def before_call(event_name, context=None, **kwargs):
+        if context is not None:
+            context["metrics_start"] = time.perf_counter()
+
+    def before_send(event_name, request=None, **kwargs):
+        length = request.headers.get("Content-Length") if request is not None else None
+        if length:
+            metrics.inc("knime_aws_bytes_sent_total", labels(event_name), float(length))
+
+    def after_call(event_name, http_response=None, parsed=None, context=None, **kwargs):
+        call_labels = labels(event_name)
+        parsed = parsed or {}
+        metrics.inc("knime_aws_api_calls_total", call_labels)
+        if context is not None and "metrics_start" in context:
+            metrics.observe("knime_aws_api_call_duration_seconds", call_labels, time.perf_counter() - context.pop("metrics_start"), CALL_BUCKETS)
+        retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        if retries:
+            metrics.inc("knime_aws_api_retries_total", call_labels, retries)
+        length = http_response.headers.get("content-length") if http_response is not None else None
+        if length:
+            metrics.inc("knime_aws_bytes_received_total", call_labels, float(length))
+        if "Error" in parsed:
+            metrics.inc("knime_aws_api_errors_total", call_labels + (("code", parsed["Error"].get("Code", "")),))
+            return
+        faces = sum(len(parsed.get(key, [])) for key in FACE_KEYS)
+        if faces > 0:
+            metrics.inc("knime_aws_faces_detected_total", call_labels, faces)
+        operation = call_labels[1][1]
+        if operation == "RunInstances":
+            metrics.inc("knime_aws_instances_launched_total", call_labels, len(parsed.get("Instances", [])))
+        elif operation == "CreateFleet":
+            metrics.inc("knime_aws_instances_launched_total", call_labels, sum(len(fleet.get("InstanceIds", [])) for fleet in parsed.get("Instances", [])))
+
+    def after_call_error(event_name, exception=None, context=None, **kwargs):
+        # connection errors and timeouts, which never reach the after-call event
+        call_labels = labels(event_name)
+        metrics.inc("knime_aws_api_calls_total", call_labels)
+        metrics.inc("knime_aws_api_errors_total", call_labels + (("code", type(exception).__name__),))
+        if context is not None and "metrics_start" in context:
+            metrics.observe("knime_aws_api_call_duration_seconds", call_labels, time.perf_counter() - context.pop("metrics_start"), CALL_BUCKETS)
+
+    events = client.meta.events
+    events.register("before-call", before_call, unique_id="knime-metrics-before-call")
+    events.register("before-send", before_send, unique_id="knime-metrics-before-send")
+    events.register("after-call", after_call, unique_id="knime-metrics-after-call")
+    events.register("after-call-error", after_call_error, unique_id="knime-metrics-after-call-error")
+    return client
+
+
+def node_of(client) -> str:
+    """Name of the node a client was instrumented for"""
+
+    try:
+        return _nodes.get(client, "")
+    except TypeError:
+        return ""
+
+
+def record_wait(node: str, operation: str, region: str, seconds: float):
+    """Record the time spent waiting for a job, instance or command"""
+
+    metrics = registry()
+    if metrics is not None:
+        metrics.observe("knime_aws_wait_duration_seconds", (("node", node), ("operation", operation), ("region", region or "")), seconds, WAIT_BUCKETS)
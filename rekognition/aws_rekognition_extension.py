@@ -1,19 +1,33 @@
 from typing import List
 import logging
 import knime_extension as knext
-import boto3
 from botocore.exceptions import ClientError
-from PIL import Image, ImageDraw, ImageColor
-import io
 import base64
+import numpy as np
 import pandas as pd
 import aws_auth
+import face_attributes
+import image_utils
+import rekognition_core
+import video_detection
 from os.path import exists
 
 
 LOGGER = logging.getLogger(__name__)
 BINARY_IMAGE_PORT_ID = "com.knime.image.binary"
 
+
+def image_view(image_bytes: bytes, output_format: str):
+    """View of an encoded image, embedded in HTML for formats without a dedicated view"""
+
+    if output_format == "JPEG":
+        return knext.view_jpeg(image_bytes)
+    if output_format == "PNG":
+        return knext.view_png(image_bytes)
+    img_str = base64.b64encode(image_bytes).decode("utf-8")
+    return knext.view_html('<img src="data:{0};base64, {1}" style="max-width: 100%; height: auto;">'.format(image_utils.MIME_TYPES[output_format], img_str))
+
+
 @knext.node(name="Amazon Rekognition Detect Faces", node_type=knext.NodeType.LEARNER, icon_path="icon.png", category="/")
 @knext.input_binary(name="AWS Authentication", description="AWS authentication credentials for accessing services", id=aws_auth.AWS_AUTH_PORT_ID)
 @knext.input_binary(name="Input Image", description="Input image data to be analysed", id=BINARY_IMAGE_PORT_ID)
@@ -23,26 +37,20 @@ BINARY_IMAGE_PORT_ID = "com.knime.image.binary"
 class DetectFacesNode(knext.PythonNode):
     """
     Apply the detect faces function of Amazon Rekognition to an image.
-    """
 
-    # Columns of the output table schema
-    columns = [
-        knext.Column(ktype=knext.string(), name="Color"),
-        knext.Column(ktype=knext.int64(), name="Age (low)"),
-        knext.Column(ktype=knext.int64(), name="Age (high)"),
-        knext.Column(ktype=knext.bool_(), name="Smile"),
-        knext.Column(ktype=knext.bool_(), name="Eye Glasses"),
-        knext.Column(ktype=knext.bool_(), name="Sun Glasses"),
-        knext.Column(ktype=knext.string(), name="Gender"),
-        knext.Column(ktype=knext.bool_(), name="Eyes Open"),
-        knext.Column(ktype=knext.bool_(), name="Mouth Open"),
-        knext.Column(ktype=knext.string(), name="Emotions")
-    ]
+    The annotated image is encoded as JPEG, WebP or PNG with the configured
+    quality, optionally as a thumbnail. In attributes only mode no image is
+    drawn, the output image is empty and the view shows the face attributes.
+    """
 
-    # Give each detected face a unique color for the bounding box.
-    # TODO - The size of this list limits the number of detected faces supported.
-    # TODO - generate these or make a bigger default list.
-    colors = ["yellow", "blue", "coral", "green", "goldenrod"]
+    include_confidence = knext.BoolParameter("Include confidences", "Add the confidence of each face attribute and emotion as columns", False)
+    include_pose = knext.BoolParameter("Include pose", "Add the roll, yaw and pitch of each face as columns", False)
+    include_quality = knext.BoolParameter("Include quality", "Add the brightness and sharpness of each face as columns", False)
+    include_landmarks = knext.BoolParameter("Include landmarks", "Add the X and Y coordinates of each facial landmark as columns", False)
+    output_format = knext.StringParameter("Output format", "Image format of the annotated image. WebP and JPEG give the smallest images, PNG is lossless.", "JPEG", enum=image_utils.OUTPUT_FORMATS)
+    quality = knext.IntParameter("Quality", "Encoding quality of JPEG and WebP images, from 1 (smallest) to 95 (best)", image_utils.DEFAULT_QUALITY, min_value=1, max_value=95)
+    max_size = knext.IntParameter("Thumbnail size", "Downscale the annotated image so its width and height are at most this number of pixels, 0 keeps the original size", 0, min_value=0)
+    attributes_only = knext.BoolParameter("Attributes only", "Output only the face attributes, without drawing and encoding an annotated image", False)
 
     def configure(self, configure_context: knext.ConfigurationContext, auth_spec: knext.BinaryPortObjectSpec, image_spec: knext.BinaryPortObjectSpec) -> List[knext.Schema]:
         """
@@ -57,7 +65,8 @@ class DetectFacesNode(knext.PythonNode):
             configure_context.set_warning("Unsupported binary port type: " + image_spec.id)
 
         # Table schema for the face attributes
-        table_schema = knext.Schema.from_columns(columns=self.columns)
+        table_schema = knext.Schema.from_columns(columns=face_attributes.face_attribute_columns(
+            self.include_confidence, self.include_pose, self.include_quality, self.include_landmarks))
 
         return knext.BinaryPortObjectSpec(BINARY_IMAGE_PORT_ID), table_schema
 
@@ -70,92 +79,43 @@ class DetectFacesNode(knext.PythonNode):
         """
 
         # Get AWS credentials and create a rekognition client
-        access_key, secret = aws_auth.decode_basic_auth(auth_input)
-        session = boto3.Session(aws_access_key_id=access_key, aws_secret_access_key=secret)
-        client = session.client("rekognition")
-
-        # Open the image to draw on it
-        image_bytes = io.BytesIO(image_input)
-        image = Image.open(image_bytes)
-        image_width, image_height = image.size
-        draw = ImageDraw.Draw(image)
-
-        LOGGER.info("Image size {0} x {1}".format(image_width, image_height))
+        client = rekognition_core.create_client(auth_input, node=type(self).__name__)
+        executor = rekognition_core.BatchExecutor(client, "detect_faces")
 
         try:
             # Invoke detect faces function of Rekognition
-            response = client.detect_faces(
-                Image={'Bytes': image_bytes.getvalue()},
-                Attributes=['ALL']
-            )            
-
-            # For each face detected, draw a rectangle
-            # over the bounds of the face on the image
-            # and collect the face attributes.
-            all_face_attrs = []
-            for (face_detail, color) in zip(response['FaceDetails'], self.colors):
-                bb = face_detail['BoundingBox']
-                left = image_width * bb['Left']
-                top = image_height * bb['Top']
-                width = image_width * bb['Width']
-                height = image_height * bb['Height']
-
-                points = (
-                    (left, top),
-                    (left + width, top),
-                    (left + width, top + height),
-                    (left, top + height),
-                    (left, top)
-                )
-
-                draw.line(points, fill=ImageColor.getrgb(color), width=4)
-
-                face_attrs = self.get_face_attributes(face_detail, color)
-                all_face_attrs.append(face_attrs)
+            response = executor.invoke({'Bytes': image_input}, {'Attributes': ['ALL']})
+
+            # Draw the boxes of all detected faces onto the image and
+            # collect the face attributes using the same colors.
+            face_details = response['FaceDetails']
+            colors = image_utils.generate_palette(len(face_details))
+            LOGGER.info("Detected {0} faces".format(len(face_details)))
 
             # Create a dataframe for the output face attributes
-            column_names = [ column.name for column in self.columns ]
-            pd_data = pd.DataFrame(data=all_face_attrs, columns=column_names)
+            pd_data = face_attributes.face_attribute_table(face_details, colors,
+                self.include_confidence, self.include_pose, self.include_quality, self.include_landmarks)
+
+            if self.attributes_only:
+                return b"", knext.Table.from_pandas(pd_data), knext.view_html(pd_data.to_html(index=False))
 
-            # Capture the bytes of the modified image
-            buffer = io.BytesIO()
-            image.save(buffer, format='JPEG')
-            image_bytes = buffer.getvalue()
+            image_bytes = image_utils.annotate_image(image_input, face_details, colors, self.output_format, self.quality, self.max_size)
 
             # Order is important here: image, attributes and the view.
-            return image_bytes, knext.Table.from_pandas(pd_data), knext.view_jpeg(image_bytes)
+            return image_bytes, knext.Table.from_pandas(pd_data), image_view(image_bytes, self.output_format)
             # Uncomment below to use the HTML view
-            #return image_bytes, knext.Table.from_pandas(pd_data), knext.view_html(self.gen_html(image_bytes))
+            #return image_bytes, knext.Table.from_pandas(pd_data), knext.view_html(self.gen_html(image_bytes, image_utils.MIME_TYPES[self.output_format]))
 
         except ClientError as err:
-            LOGGER.error("error invoking detect faces service: {0}; code: ".format(err.response['Error']['Message'], err.response['Error']['Code']))
+            LOGGER.error("error invoking detect faces service: {0}; code: {1}".format(err.response['Error']['Message'], err.response['Error']['Code']))
             return None
 
 
-    def get_face_attributes(self, fd: dict, color: str): 
-        """Collect attributes from the detect faces results"""
-
-        age_low = fd['AgeRange']['Low']
-        age_high = fd['AgeRange']['High']
-        smile = fd['Smile']['Value']
-        eye_glasses = fd['Eyeglasses']['Value']
-        sun_glasses = fd['Sunglasses']['Value']
-        gender = fd['Gender']['Value']
-        eyes_open = fd['EyesOpen']['Value']
-        mouth_open = fd['MouthOpen']['Value']
-
-        # Concatenate all emotions into a single string
-        emotions_list = [ emotion['Type'] for emotion in fd['Emotions'] if emotion['Confidence'] > 50.0 ]
-        emotions = ", ".join(emotions_list)
-
-        return [color, age_low, age_high, smile, eye_glasses, sun_glasses, gender, eyes_open, mouth_open, emotions]
-
-
     # Experimenting with generating HTML with the image embedded and with face attributes.
     # The HTML can then be used as input to an HTML view.
     # Goal is to have the attributes next to the image.
     # TODO only the image is displayed.
-    def gen_html(self, image_bytes: bytes) -> str:
+    def gen_html(self, image_bytes: bytes, mime_type: str = "image/jpeg") -> str:
         """
         Experimenting here with generating HTML embedding the modified image.
         The HTML can mix the image and the face attributes and be fed into
@@ -163,7 +123,7 @@ class DetectFacesNode(knext.PythonNode):
         """
 
         img_str = base64.b64encode(image_bytes).decode("utf-8")
-        html = self.base_html % img_str
+        html = self.base_html % (mime_type, img_str)
         return html
 
     base_html = """
@@ -193,7 +153,7 @@ class DetectFacesNode(knext.PythonNode):
             <body>
                 <div class="row">
                     <div class="column left">
-                        <img src="data:image/jpeg;base64, %s">
+                        <img src="data:%s;base64, %s">
                     </div>
                     <div class="column right">
                         <h1>Hello</h1>
@@ -204,6 +164,363 @@ class DetectFacesNode(knext.PythonNode):
     """
     
 
+@knext.node(name="Amazon Rekognition Detect Faces in Video", node_type=knext.NodeType.LEARNER, icon_path="icon.png", category="/")
+@knext.input_binary(name="AWS Authentication", description="AWS authentication credentials for accessing services", id=aws_auth.AWS_AUTH_PORT_ID)
+@knext.input_table(name="Videos", description="Table containing the S3 URIs (s3://bucket/key) of the videos to be analysed")
+@knext.output_table(name="Face Attributes", description="Attributes of each face detected in the videos with the timestamp of its frame")
+class DetectFacesInVideoNode(knext.PythonNode):
+    """
+    Apply the stored video face detection of Amazon Rekognition to videos in S3.
+
+    One asynchronous face detection job is started per distinct video and
+    the jobs run concurrently. Each job is polled until it finishes and its
+    results are paged into the output table, one row per face and frame.
+    The videos have to be stored in an S3 bucket in the selected region.
+    """
+
+    video_column = knext.ColumnParameter(label="Video URI Column", description="Choose the column containing the S3 URIs of the videos", port_index=1, include_row_key=False, include_none_column=False)
+    region = knext.StringParameter("Region", "Region of the Rekognition service and the S3 bucket. Leave blank to use the default region.", "")
+    max_jobs = knext.IntParameter("Concurrent jobs", "Maximum number of face detection jobs running at the same time", 10, min_value=1, max_value=20)
+    poll_interval = knext.IntParameter("Poll interval (seconds)", "Initial wait between two status checks of a running job", 5, min_value=1, max_value=60)
+    include_confidence = knext.BoolParameter("Include confidences", "Add the confidence of each face attribute and emotion as columns", False)
+    include_pose = knext.BoolParameter("Include pose", "Add the roll, yaw and pitch of each face as columns", False)
+    include_quality = knext.BoolParameter("Include quality", "Add the brightness and sharpness of each face as columns", False)
+    include_landmarks = knext.BoolParameter("Include landmarks", "Add the X and Y coordinates of each facial landmark as columns", False)
+
+    # Columns identifying the video frame of each detected face
+    columns = [
+        knext.Column(ktype=knext.string(), name="Video"),
+        knext.Column(ktype=knext.string(), name="Job ID"),
+        knext.Column(ktype=knext.int64(), name="Timestamp (ms)")
+    ]
+
+    def configure(self, configure_context: knext.ConfigurationContext, auth_spec: knext.BinaryPortObjectSpec, input_schema_1) -> List[knext.Schema]:
+        """Configure the output table with the frame columns and the face attributes"""
+
+        if auth_spec.id != aws_auth.AWS_AUTH_PORT_ID:
+            configure_context.set_warning("Unsupported binary port type: " + auth_spec.id)
+
+        return knext.Schema.from_columns(columns=self.columns + face_attributes.face_attribute_columns(
+            self.include_confidence, self.include_pose, self.include_quality, self.include_landmarks,
+            include_color=False, include_bounding_box=True))
+
+
+    def execute(self, exec_context: knext.ExecutionContext, auth_input, input_1):
+        """
+        Start a face detection job for every distinct video, wait for the jobs
+        concurrently and collect the faces of each job as soon as it finishes.
+        """
+
+        client = rekognition_core.create_client(auth_input, self.region, self.max_jobs, node=type(self).__name__)
+
+        video_uris = [ uri for uri in input_1.to_pandas()[self.video_column].tolist() if isinstance(uri, str) and len(uri) > 0 ]
+        total = max(1, len(dict.fromkeys(video_uris)))
+
+        frames = []
+        failed = []
+        results = video_detection.detect_faces_in_videos(client, video_uris, self.max_jobs, self.poll_interval, exec_context.is_canceled)
+        for count, (uri, job_id, timestamps, face_details, err) in enumerate(results, start=1):
+            exec_context.set_progress(count / total, "Finished {0} of {1} videos".format(count, total))
+            if err is not None:
+                failed.append(uri)
+                continue
+            frames.append(self.video_faces(uri, job_id, timestamps, face_details))
+
+        if len(failed) > 0:
+            exec_context.set_warning("Face detection failed for {0} video(s): {1}".format(len(failed), ", ".join(failed)))
+
+        if len(frames) == 0:
+            frames.append(self.video_faces("", "", [], []))
+
+        return knext.Table.from_pandas(pd.concat(frames, ignore_index=True))
+
+
+    def video_faces(self, uri: str, job_id: str, timestamps: List[int], face_details: List[dict]) -> pd.DataFrame:
+        """Face attribute table of one video, prefixed with the frame columns"""
+
+        pd_data = face_attributes.face_attribute_table(face_details, None,
+            self.include_confidence, self.include_pose, self.include_quality, self.include_landmarks,
+            include_bounding_box=True)
+        pd_data.insert(0, "Timestamp (ms)", pd.array(timestamps, dtype="Int64"))
+        pd_data.insert(0, "Job ID", job_id)
+        pd_data.insert(0, "Video", uri)
+        return pd_data
+
+
+@knext.node(name="Amazon Rekognition Detect Faces (Table)", node_type=knext.NodeType.LEARNER, icon_path="icon.png", category="/")
+@knext.input_binary(name="AWS Authentication", description="AWS authentication credentials for accessing services", id=aws_auth.AWS_AUTH_PORT_ID)
+@knext.input_table(name="Images", description="Table containing the images to be analysed as binary data, S3 URIs or local file paths")
+@knext.output_table(name="Face Attributes", description="Attributes of each face detected in the images")
+@knext.output_table(name="Annotated Images", description="Images overlayed with bounding boxes of the detected faces, missing for images that could not be annotated")
+class DetectFacesTableNode(knext.PythonNode):
+    """
+    Apply the detect faces function of Amazon Rekognition to every image of a table.
+
+    The images are analysed concurrently. Each image column cell can hold the
+    image data, an S3 URI (s3://bucket/key) or the path of a local image file.
+    Annotated images are only created for images that are not read from S3.
+    They are drawn in separate processes while the remaining images are
+    still being analysed, and encoded as JPEG, WebP or PNG with the
+    configured quality, optionally as thumbnails. In attributes only mode
+    no images are drawn and the Annotated Images table is empty.
+    """
+
+    image_column = knext.ColumnParameter(label="Image Column", description="Choose the column containing the images", port_index=1, include_row_key=False, include_none_column=False)
+    region = knext.StringParameter("Region", "Region of the Rekognition service. Leave blank to use the default region.", "")
+    max_workers = knext.IntParameter("Concurrent requests", "Maximum number of images analysed at the same time", 10, min_value=1, max_value=50)
+    use_cache = knext.BoolParameter("Cache results", "Analyse repeated images only once per execution", True)
+    include_confidence = knext.BoolParameter("Include confidences", "Add the confidence of each face attribute and emotion as columns", False)
+    include_pose = knext.BoolParameter("Include pose", "Add the roll, yaw and pitch of each face as columns", False)
+    include_quality = knext.BoolParameter("Include quality", "Add the brightness and sharpness of each face as columns", False)
+    include_landmarks = knext.BoolParameter("Include landmarks", "Add the X and Y coordinates of each facial landmark as columns", False)
+    output_format = knext.StringParameter("Output format", "Image format of the annotated images. WebP and JPEG give the smallest images, PNG is lossless.", "JPEG", enum=image_utils.OUTPUT_FORMATS)
+    quality = knext.IntParameter("Quality", "Encoding quality of JPEG and WebP images, from 1 (smallest) to 95 (best)", image_utils.DEFAULT_QUALITY, min_value=1, max_value=95)
+    max_size = knext.IntParameter("Thumbnail size", "Downscale the annotated images so their width and height are at most this number of pixels, 0 keeps the original size", 0, min_value=0)
+    attributes_only = knext.BoolParameter("Attributes only", "Output only the face attributes, without drawing and encoding annotated images", False)
+    render_processes = knext.IntParameter("Drawing processes", "Number of processes drawing the annotated images. 0 uses one per CPU core, 1 draws them in the node process.", 0, min_value=0, max_value=64)
+
+    image_columns = [
+        rekognition_core.SOURCE_ROW_COLUMN,
+        knext.Column(ktype=knext.blob(), name="Image")
+    ]
+
+    def configure(self, configure_context: knext.ConfigurationContext, auth_spec: knext.BinaryPortObjectSpec, input_schema_1) -> List[knext.Schema]:
+        """Configure the face attribute table and the table of annotated images"""
+
+        if auth_spec.id != aws_auth.AWS_AUTH_PORT_ID:
+            configure_context.set_warning("Unsupported binary port type: " + auth_spec.id)
+
+        face_schema = knext.Schema.from_columns(columns=[rekognition_core.SOURCE_ROW_COLUMN] + face_attributes.face_attribute_columns(
+            self.include_confidence, self.include_pose, self.include_quality, self.include_landmarks, include_bounding_box=True))
+        return face_schema, knext.Schema.from_columns(columns=self.image_columns)
+
+
+    def execute(self, exec_context: knext.ExecutionContext, auth_input, input_1):
+        """Detect the faces of all images and draw their bounding boxes"""
+
+        client = rekognition_core.create_client(auth_input, self.region, self.max_workers, node=type(self).__name__)
+        input_1_pd = input_1.to_pandas()
+
+        collected = {}
+
+        with image_utils.RenderPipeline(self.render_processes, output_format=self.output_format, quality=self.quality, max_size=self.max_size) as pipeline:
+            # images are queued for drawing as their responses arrive, overlapping with the remaining calls
+            def collect(index: int, result: rekognition_core.BatchResult):
+                if result.response is None:
+                    return
+                row_faces = result.response['FaceDetails']
+                row_colors = image_utils.generate_palette(len(row_faces))
+                collected[index] = (result.row_key, row_faces, row_colors)
+                if result.image_bytes is not None:
+                    pipeline.submit((index, result.row_key), result.image_bytes, row_faces, row_colors)
+                    result.image_bytes = None
+
+            rekognition_core.run_batch(exec_context, client, "detect_faces", input_1_pd, self.image_column,
+                self.max_workers, self.use_cache, lambda index: {'Attributes': ['ALL']}, keep_image_bytes=not self.attributes_only, on_result=collect)
+            annotated = sorted(pipeline.results(), key=lambda item: item[0])
+
+        # the responses arrive in completion order, the outputs keep the order of the input rows
+        source_rows = [collected[index][0] for index in sorted(collected) for _ in collected[index][1]]
+        face_details = [face for index in sorted(collected) for face in collected[index][1]]
+        colors = [color for index in sorted(collected) for color in collected[index][2]]
+        image_rows = [row_key for (_, row_key), _ in annotated]
+        images = [image for _, image in annotated]
+
+        pd_faces = face_attributes.face_attribute_table(face_details, colors,
+            self.include_confidence, self.include_pose, self.include_quality, self.include_landmarks,
+            include_bounding_box=True)
+        pd_faces.insert(0, rekognition_core.SOURCE_ROW_COLUMN.name, source_rows)
+        pd_images = pd.DataFrame({rekognition_core.SOURCE_ROW_COLUMN.name: image_rows, "Image": images})
+
+        return knext.Table.from_pandas(pd_faces), knext.Table.from_pandas(pd_images)
+
+
+@knext.node(name="Amazon Rekognition Detect Labels", node_type=knext.NodeType.LEARNER, icon_path="icon.png", category="/")
+@knext.input_binary(name="AWS Authentication", description="AWS authentication credentials for accessing services", id=aws_auth.AWS_AUTH_PORT_ID)
+@knext.input_table(name="Images", description="Table containing the images to be analysed as binary data, S3 URIs or local file paths")
+@knext.output_table(name="Labels", description="Labels detected in each image")
+class DetectLabelsNode(knext.PythonNode):
+    """
+    Apply the detect labels function of Amazon Rekognition to every image of a table.
+
+    The images are analysed concurrently. Each image column cell can hold the
+    image data, an S3 URI (s3://bucket/key) or the path of a local image file.
+    """
+
+    image_column = knext.ColumnParameter(label="Image Column", description="Choose the column containing the images", port_index=1, include_row_key=False, include_none_column=False)
+    region = knext.StringParameter("Region", "Region of the Rekognition service. Leave blank to use the default region.", "")
+    max_workers = knext.IntParameter("Concurrent requests", "Maximum number of images analysed at the same time", 10, min_value=1, max_value=50)
+    use_cache = knext.BoolParameter("Cache results", "Analyse repeated images only once per execution", True)
+    max_labels = knext.IntParameter("Maximum labels", "Maximum number of labels returned per image", 20, min_value=1, max_value=1000)
+    min_confidence = knext.DoubleParameter("Minimum confidence", "Minimum confidence of the returned labels", 55.0, min_value=0.0, max_value=100.0)
+
+    def configure(self, configure_context: knext.ConfigurationContext, auth_spec: knext.BinaryPortObjectSpec, input_schema_1) -> List[knext.Schema]:
+        """Configure the label table"""
+
+        if auth_spec.id != aws_auth.AWS_AUTH_PORT_ID:
+            configure_context.set_warning("Unsupported binary port type: " + auth_spec.id)
+
+        return knext.Schema.from_columns(columns=rekognition_core.item_columns(rekognition_core.LABEL_COLUMNS) + [
+            knext.Column(ktype=knext.string(), name="Parents"),
+            knext.Column(ktype=knext.int64(), name="Instances")
+        ])
+
+
+    def execute(self, exec_context: knext.ExecutionContext, auth_input, input_1):
+        """Detect the labels of all images"""
+
+        client = rekognition_core.create_client(auth_input, self.region, self.max_workers, node=type(self).__name__)
+        params = { 'MaxLabels': self.max_labels, 'MinConfidence': self.min_confidence }
+        results = rekognition_core.run_batch(exec_context, client, "detect_labels", input_1.to_pandas(), self.image_column,
+            self.max_workers, self.use_cache, lambda index: params)
+
+        source_rows, labels = rekognition_core.collect_items(results, 'Labels')
+        pd_data = rekognition_core.item_table(source_rows, labels, rekognition_core.LABEL_COLUMNS)
+        pd_data["Parents"] = np.array([ ", ".join(parent['Name'] for parent in label.get('Parents', [])) for label in labels ], dtype=object)
+        pd_data["Instances"] = np.array([ len(label.get('Instances', [])) for label in labels ], dtype=np.int64)
+        return knext.Table.from_pandas(pd_data)
+
+
+@knext.node(name="Amazon Rekognition Detect Text", node_type=knext.NodeType.LEARNER, icon_path="icon.png", category="/")
+@knext.input_binary(name="AWS Authentication", description="AWS authentication credentials for accessing services", id=aws_auth.AWS_AUTH_PORT_ID)
+@knext.input_table(name="Images", description="Table containing the images to be analysed as binary data, S3 URIs or local file paths")
+@knext.output_table(name="Text", description="Lines and words of text detected in each image")
+class DetectTextNode(knext.PythonNode):
+    """
+    Apply the detect text function of Amazon Rekognition to every image of a table.
+
+    The images are analysed concurrently. Each image column cell can hold the
+    image data, an S3 URI (s3://bucket/key) or the path of a local image file.
+    """
+
+    image_column = knext.ColumnParameter(label="Image Column", description="Choose the column containing the images", port_index=1, include_row_key=False, include_none_column=False)
+    region = knext.StringParameter("Region", "Region of the Rekognition service. Leave blank to use the default region.", "")
+    max_workers = knext.IntParameter("Concurrent requests", "Maximum number of images analysed at the same time", 10, min_value=1, max_value=50)
+    use_cache = knext.BoolParameter("Cache results", "Analyse repeated images only once per execution", True)
+
+    def configure(self, configure_context: knext.ConfigurationContext, auth_spec: knext.BinaryPortObjectSpec, input_schema_1) -> List[knext.Schema]:
+        """Configure the text table"""
+
+        if auth_spec.id != aws_auth.AWS_AUTH_PORT_ID:
+            configure_context.set_warning("Unsupported binary port type: " + auth_spec.id)
+
+        return knext.Schema.from_columns(columns=rekognition_core.item_columns(rekognition_core.TEXT_COLUMNS))
+
+
+    def execute(self, exec_context: knext.ExecutionContext, auth_input, input_1):
+        """Detect the text of all images"""
+
+        client = rekognition_core.create_client(auth_input, self.region, self.max_workers, node=type(self).__name__)
+        results = rekognition_core.run_batch(exec_context, client, "detect_text", input_1.to_pandas(), self.image_column,
+            self.max_workers, self.use_cache)
+
+        source_rows, detections = rekognition_core.collect_items(results, 'TextDetections')
+        return knext.Table.from_pandas(rekognition_core.item_table(source_rows, detections, rekognition_core.TEXT_COLUMNS))
+
+
+@knext.node(name="Amazon Rekognition Search Faces by Image", node_type=knext.NodeType.LEARNER, icon_path="icon.png", category="/")
+@knext.input_binary(name="AWS Authentication", description="AWS authentication credentials for accessing services", id=aws_auth.AWS_AUTH_PORT_ID)
+@knext.input_table(name="Images", description="Table containing the images to be searched as binary data, S3 URIs or local file paths")
+@knext.output_table(name="Face Matches", description="Faces of the collection matching the largest face of each image")
+class SearchFacesByImageNode(knext.PythonNode):
+    """
+    Search a Rekognition face collection for the largest face of every image of a table.
+
+    The images are searched concurrently. Each image column cell can hold the
+    image data, an S3 URI (s3://bucket/key) or the path of a local image file.
+    """
+
+    image_column = knext.ColumnParameter(label="Image Column", description="Choose the column containing the images", port_index=1, include_row_key=False, include_none_column=False)
+    region = knext.StringParameter("Region", "Region of the Rekognition service. Leave blank to use the default region.", "")
+    max_workers = knext.IntParameter("Concurrent requests", "Maximum number of images searched at the same time", 10, min_value=1, max_value=50)
+    use_cache = knext.BoolParameter("Cache results", "Search repeated images only once per execution", True)
+    collection_id = knext.StringParameter("Collection ID", "ID of the face collection to search", "")
+    max_faces = knext.IntParameter("Maximum matches", "Maximum number of matching faces returned per image", 10, min_value=1, max_value=4096)
+    face_match_threshold = knext.DoubleParameter("Match threshold", "Minimum similarity of the returned matches", 80.0, min_value=0.0, max_value=100.0)
+
+    def configure(self, configure_context: knext.ConfigurationContext, auth_spec: knext.BinaryPortObjectSpec, input_schema_1) -> List[knext.Schema]:
+        """Configure the face match table"""
+
+        if auth_spec.id != aws_auth.AWS_AUTH_PORT_ID:
+            configure_context.set_warning("Unsupported binary port type: " + auth_spec.id)
+        if len(self.collection_id) == 0:
+            configure_context.set_warning("Input the ID of the face collection to search")
+
+        return knext.Schema.from_columns(columns=rekognition_core.item_columns(rekognition_core.FACE_MATCH_COLUMNS))
+
+
+    def execute(self, exec_context: knext.ExecutionContext, auth_input, input_1):
+        """Search the collection for the faces of all images"""
+
+        client = rekognition_core.create_client(auth_input, self.region, self.max_workers, node=type(self).__name__)
+        params = { 'CollectionId': self.collection_id, 'MaxFaces': self.max_faces, 'FaceMatchThreshold': self.face_match_threshold }
+        results = rekognition_core.run_batch(exec_context, client, "search_faces_by_image", input_1.to_pandas(), self.image_column,
+            self.max_workers, self.use_cache, lambda index: params)
+
+        source_rows, matches = rekognition_core.collect_items(results, 'FaceMatches')
+        return knext.Table.from_pandas(rekognition_core.item_table(source_rows, matches, rekognition_core.FACE_MATCH_COLUMNS))
+
+
+@knext.node(name="Amazon Rekognition Index Faces", node_type=knext.NodeType.LEARNER, icon_path="icon.png", category="/")
+@knext.input_binary(name="AWS Authentication", description="AWS authentication credentials for accessing services", id=aws_auth.AWS_AUTH_PORT_ID)
+@knext.input_table(name="Images", description="Table containing the images to be indexed as binary data, S3 URIs or local file paths")
+@knext.output_table(name="Indexed Faces", description="Faces added to the collection from each image")
+class IndexFacesNode(knext.PythonNode):
+    """
+    Add the faces of every image of a table to a Rekognition face collection.
+
+    The images are indexed concurrently. Each image column cell can hold the
+    image data, an S3 URI (s3://bucket/key) or the path of a local image file.
+    Repeated images with the same external image ID are indexed only once
+    per execution when results are cached.
+    """
+
+    image_column = knext.ColumnParameter(label="Image Column", description="Choose the column containing the images", port_index=1, include_row_key=False, include_none_column=False)
+    external_id_column = knext.ColumnParameter(label="External Image ID Column", description="Optionally choose a column containing the external image ID stored with the faces", port_index=1, include_row_key=False, include_none_column=True)
+    region = knext.StringParameter("Region", "Region of the Rekognition service. Leave blank to use the default region.", "")
+    max_workers = knext.IntParameter("Concurrent requests", "Maximum number of images indexed at the same time", 10, min_value=1, max_value=50)
+    use_cache = knext.BoolParameter("Cache results", "Index repeated images only once per execution", True)
+    collection_id = knext.StringParameter("Collection ID", "ID of the face collection to add the faces to", "")
+    max_faces = knext.IntParameter("Maximum faces", "Maximum number of faces indexed per image", 100, min_value=1, max_value=100)
+    quality_filter = knext.StringParameter("Quality filter", "Filter out faces that do not meet the quality bar", "AUTO", enum=["AUTO", "NONE", "LOW", "MEDIUM", "HIGH"])
+
+    def configure(self, configure_context: knext.ConfigurationContext, auth_spec: knext.BinaryPortObjectSpec, input_schema_1) -> List[knext.Schema]:
+        """Configure the indexed face table"""
+
+        if auth_spec.id != aws_auth.AWS_AUTH_PORT_ID:
+            configure_context.set_warning("Unsupported binary port type: " + auth_spec.id)
+        if len(self.collection_id) == 0:
+            configure_context.set_warning("Input the ID of the face collection to add the faces to")
+
+        return knext.Schema.from_columns(columns=rekognition_core.item_columns(rekognition_core.FACE_RECORD_COLUMNS))
+
+
+    def execute(self, exec_context: knext.ExecutionContext, auth_input, input_1):
+        """Index the faces of all images"""
+
+        client = rekognition_core.create_client(auth_input, self.region, self.max_workers, node=type(self).__name__)
+        input_1_pd = input_1.to_pandas()
+        params = { 'CollectionId': self.collection_id, 'MaxFaces': self.max_faces, 'QualityFilter': self.quality_filter }
+        external_ids = None
+        if self.external_id_column not in (None, "<none>"):
+            external_ids = input_1_pd[self.external_id_column].tolist()
+
+        def row_params(index: int) -> dict:
+            if external_ids is None or not isinstance(external_ids[index], str) or len(external_ids[index]) == 0:
+                return params
+            return dict(params, ExternalImageId=external_ids[index])
+
+        results = rekognition_core.run_batch(exec_context, client, "index_faces", input_1_pd, self.image_column,
+            self.max_workers, self.use_cache, row_params)
+
+        unindexed = sum(len(result.response.get('UnindexedFaces', [])) for result in results if result.response is not None)
+        if unindexed > 0:
+            LOGGER.warning("{0} faces were not indexed because of the quality filter or the face limit".format(unindexed))
+
+        source_rows, records = rekognition_core.collect_items(results, 'FaceRecords')
+        return knext.Table.from_pandas(rekognition_core.item_table(source_rows, records, rekognition_core.FACE_RECORD_COLUMNS))
+
+
 @knext.node(name="AWS Authentication (Python)", node_type=knext.NodeType.SOURCE, icon_path="icon.png", category="/")
 @knext.output_binary(name="Authentication Data", description="AWS authentication credentials", id=aws_auth.AWS_AUTH_PORT_ID)
 class SimpleAuthNode(knext.PythonNode):
@@ -240,16 +557,21 @@ class ImageReaderNode(knext.PythonNode):
     through a Python binary port. Passing an KNIME type image in a table
     cell does not work yet.
 
-    This may only support JPEG images. Used JPEG as the image file size
-    is generally smaller than other image formats.
+    Images are passed on as JPEG as the image file size is generally
+    smaller than other image formats. JPEG files are passed on as they are
+    without decoding them, other formats are converted. A maximum size lets
+    large JPEG files decode at reduced scale; TIFF, PNG and other formats
+    are decoded in full, so very large scans need memory for the whole image.
 
     Parameters
     ----------
     filepath_param: A fully qualified path to a local image file.
     (this should use a file chooser widget when it's available)
+    max_size: The maximum width and height of the output image, 0 keeps the original size.
     """
 
     filepath_param = knext.StringParameter(label="Path to image file", description="Input a complete file path to an image file")
+    max_size = knext.IntParameter("Maximum size", "Downscale images whose width or height exceeds this number of pixels, 0 keeps the original size. JPEG files are decoded at reduced scale, other formats in full", 0, min_value=0)
 
     def configure(self, configure_context: knext.ConfigurationContext) -> List[knext.Schema]:
         """Configure a single binary output port for image contents"""
@@ -263,23 +585,91 @@ class ImageReaderNode(knext.PythonNode):
     def execute(self, exec_context: knext.ExecutionContext):
         """Read the image file and push the image bytes to the output port"""
         
-        im = Image.open(self.filepath_param, "r")
-        byteArray = io.BytesIO()
-        im.save(byteArray, format='JPEG')
-        bytes = byteArray.getvalue()
-        LOGGER.info("image size: {0} bytes".format(len(bytes)))
+        bytes, source_format = image_utils.read_image_file(self.filepath_param, "JPEG", self.max_size)
+        LOGGER.info("image size: {0} bytes (read from {1})".format(len(bytes), source_format))
 
         return bytes
 
 
+@knext.node(name="Image Folder Reader (Python)", node_type=knext.NodeType.SOURCE, icon_path="icon.png", category="/")
+@knext.output_table(name="Images", description="Table with one row per image file")
+class ImageFolderReaderNode(knext.PythonNode):
+    """
+    Read all image files of a directory or glob pattern into a table of binary image cells.
+
+    The table can be fed into the table based Rekognition nodes. As in the
+    Image Reader, JPEG files are passed on as they are and other formats
+    are converted to JPEG. Files that cannot be read as images are skipped.
+    The maximum size only bounds the memory of decoding JPEG files, other
+    formats are decoded in full before they are downscaled.
+
+    Parameters
+    ----------
+    path_param: A directory or a glob pattern such as /data/scans/**/*.tif
+    max_size: The maximum width and height of the output images, 0 keeps the original size.
+    """
+
+    path_param = knext.StringParameter(label="Directory or glob pattern", description="Input a directory or a glob pattern matching the image files")
+    max_size = knext.IntParameter("Maximum size", "Downscale images whose width or height exceeds this number of pixels, 0 keeps the original size. JPEG files are decoded at reduced scale, other formats in full", 0, min_value=0)
+
+    columns = [
+        knext.Column(ktype=knext.string(), name="Path"),
+        knext.Column(ktype=knext.string(), name="Source Format"),
+        knext.Column(ktype=knext.blob(), name="Image")
+    ]
+
+    def configure(self, configure_context: knext.ConfigurationContext) -> List[knext.Schema]:
+        """Configure a single table output port for the images"""
+
+        if self.path_param == None or len(self.path_param) == 0:
+            configure_context.set_warning("Input a directory or a glob pattern")
+
+        return knext.Schema.from_columns(columns=self.columns)
+
+
+    def execute(self, exec_context: knext.ExecutionContext):
+        """Read every matching image file in a single pass"""
+
+        paths = image_utils.list_image_files(self.path_param)
+        read_paths = []
+        formats = []
+        images = []
+        skipped = []
+        for count, path in enumerate(paths, start=1):
+            try:
+                image_bytes, source_format = image_utils.read_image_file(path, "JPEG", self.max_size)
+            except Exception as err:
+                LOGGER.warning("skipping {0}: {1}".format(path, err))
+                skipped.append(path)
+                continue
+            read_paths.append(path)
+            formats.append(source_format)
+            images.append(image_bytes)
+            exec_context.set_progress(count / len(paths), "Read {0} of {1} files".format(count, len(paths)))
+
+        if len(paths) == 0:
+            exec_context.set_warning("No image files found for " + self.path_param)
+        elif len(skipped) > 0:
+            exec_context.set_warning("Skipped {0} files that could not be read as images".format(len(skipped)))
+
+        return knext.Table.from_pandas(pd.DataFrame({"Path": read_paths, "Source Format": formats, "Image": images}))
+
+
 @knext.node(name="Image Viewer (Python)", node_type=knext.NodeType.VISUALIZER, icon_path="icon.png", category="/")
 @knext.input_binary(name="Input image", description="Input image to display in a view", id=BINARY_IMAGE_PORT_ID)
 @knext.output_view(name="Image View", description="View the input image")
 class ImageViewerNode(knext.PythonNode):
     """
-    Create a (JPEG) view of the input image.
+    Create a view of the input image, encoded as JPEG, WebP or PNG.
+
+    Choose a lower quality or a thumbnail size to keep views of large
+    images small and fast.
     """
 
+    output_format = knext.StringParameter("Output format", "Image format of the view. WebP and JPEG give the smallest images, PNG is lossless.", "JPEG", enum=image_utils.OUTPUT_FORMATS)
+    quality = knext.IntParameter("Quality", "Encoding quality of JPEG and WebP images, from 1 (smallest) to 95 (best)", image_utils.DEFAULT_QUALITY, min_value=1, max_value=95)
+    max_size = knext.IntParameter("Thumbnail size", "Downscale the image so its width and height are at most this number of pixels, 0 keeps the original size", 0, min_value=0)
+
     # Defines a single binary input port and no output ports.
     def configure(self, configure_context: knext.ConfigurationContext, input_spec: knext.BinaryPortObjectSpec) -> List[knext.Schema]:
         """Configure a single input binary port for the image data"""
@@ -289,13 +679,10 @@ class ImageViewerNode(knext.PythonNode):
             
         return []
 
-    # Reads the image bytes from the input port, converts to JPEG
-    # and creates a JPEG viewer.
+    # Reads the image bytes from the input port, converts them to the
+    # output format and creates a viewer.
     def execute(self, exec_context: knext.ExecutionContext, input_1):
-        """Read the image bytes and prepare them for the JPEG view"""
+        """Read the image bytes and prepare them for the view"""
         
-        image_bytes = io.BytesIO(input_1)
-        image = Image.open(image_bytes)
-        buffer = io.BytesIO()
-        image.save(buffer, format='JPEG')
-        return knext.view_jpeg(buffer.getvalue())
+        image = image_utils.open_image(input_1, self.max_size)
+        return image_view(image_utils.encode_image(image, self.output_format, self.quality), self.output_format)
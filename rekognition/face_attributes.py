@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+import knime_extension as knext
+from typing import List, Optional
+
+
+# Emotion types reported by Rekognition for each face
+EMOTION_TYPES = ["HAPPY", "SAD", "ANGRY", "CONFUSED", "DISGUSTED", "SURPRISED", "CALM", "FEAR", "UNKNOWN"]
+
+# Emotions with a confidence above this threshold are listed in the Emotions column
+EMOTION_THRESHOLD = 50.0
+
+# Landmark types reported by Rekognition for each face
+LANDMARK_TYPES = [
+    "eyeLeft", "eyeRight", "nose", "mouthLeft", "mouthRight",
+    "leftEyeBrowLeft", "leftEyeBrowRight", "leftEyeBrowUp",
+    "rightEyeBrowLeft", "rightEyeBrowRight", "rightEyeBrowUp",
+    "leftEyeLeft", "leftEyeRight", "leftEyeUp", "leftEyeDown",
+    "rightEyeLeft", "rightEyeRight", "rightEyeUp", "rightEyeDown",
+    "noseLeft", "noseRight", "mouthUp", "mouthDown", "leftPupil", "rightPupil",
+    "upperJawlineLeft", "midJawlineLeft", "chinBottom", "midJawlineRight", "upperJawlineRight"
+]
+
+# Column definitions as (column name, KNIME type, pandas dtype, path into a face detail)
+BASE_COLUMNS = [
+    ("Age (low)", knext.int64(), "Int64", ("AgeRange", "Low")),
+    ("Age (high)", knext.int64(), "Int64", ("AgeRange", "High")),
+    ("Smile", knext.bool_(), "boolean", ("Smile", "Value")),
+    ("Eye Glasses", knext.bool_(), "boolean", ("Eyeglasses", "Value")),
+    ("Sun Glasses", knext.bool_(), "boolean", ("Sunglasses", "Value")),
+    ("Gender", knext.string(), object, ("Gender", "Value")),
+    ("Eyes Open", knext.bool_(), "boolean", ("EyesOpen", "Value")),
+    ("Mouth Open", knext.bool_(), "boolean", ("MouthOpen", "Value")),
+]
+
+CONFIDENCE_COLUMNS = [
+    ("Face Confidence", knext.double(), "float64", ("Confidence",)),
+    ("Smile Confidence", knext.double(), "float64", ("Smile", "Confidence")),
+    ("Eye Glasses Confidence", knext.double(), "float64", ("Eyeglasses", "Confidence")),
+    ("Sun Glasses Confidence", knext.double(), "float64", ("Sunglasses", "Confidence")),
+    ("Gender Confidence", knext.double(), "float64", ("Gender", "Confidence")),
+    ("Eyes Open Confidence", knext.double(), "float64", ("EyesOpen", "Confidence")),
+    ("Mouth Open Confidence", knext.double(), "float64", ("MouthOpen", "Confidence")),
+]
+
+POSE_COLUMNS = [
+    ("Pose Roll", knext.double(), "float64", ("Pose", "Roll")),
+    ("Pose Yaw", knext.double(), "float64", ("Pose", "Yaw")),
+    ("Pose Pitch", knext.double(), "float64", ("Pose", "Pitch")),
+]
+
+BOUNDING_BOX_COLUMNS = [
+    ("Box Left", knext.double(), "float64", ("BoundingBox", "Left")),
+    ("Box Top", knext.double(), "float64", ("BoundingBox", "Top")),
+    ("Box Width", knext.double(), "float64", ("BoundingBox", "Width")),
+    ("Box Height", knext.double(), "float64", ("BoundingBox", "Height")),
+]
+
+QUALITY_COLUMNS = [
+    ("Quality Brightness", knext.double(), "float64", ("Quality", "Brightness")),
+    ("Quality Sharpness", knext.double(), "float64", ("Quality", "Sharpness")),
+]
+
+
+def face_attribute_columns(include_confidence: bool = False, include_pose: bool = False,
+                           include_quality: bool = False, include_landmarks: bool = False,
+                           include_color: bool = True, include_bounding_box: bool = False) -> List[knext.Column]:
+    """Columns of the face attribute table for the given optional column groups"""
+
+    columns = [knext.Column(ktype=knext.string(), name="Color")] if include_color else []
+    if include_bounding_box:
+        columns += [knext.Column(ktype=ktype, name=name) for (name, ktype, _, _) in BOUNDING_BOX_COLUMNS]
+    columns += [knext.Column(ktype=ktype, name=name) for (name, ktype, _, _) in BASE_COLUMNS]
+    columns.append(knext.Column(ktype=knext.string(), name="Emotions"))
+
+    if include_confidence:
+        columns += [knext.Column(ktype=ktype, name=name) for (name, ktype, _, _) in CONFIDENCE_COLUMNS]
+        columns += [knext.Column(ktype=knext.double(), name=emotion_column(emotion)) for emotion in EMOTION_TYPES]
+    if include_pose:
+        columns += [knext.Column(ktype=ktype, name=name) for (name, ktype, _, _) in POSE_COLUMNS]
+    if include_quality:
+        columns += [knext.Column(ktype=ktype, name=name) for (name, ktype, _, _) in QUALITY_COLUMNS]
+    if include_landmarks:
+        for landmark in LANDMARK_TYPES:
+            columns.append(knext.Column(ktype=knext.double(), name=landmark_column(landmark, "X")))
+            columns.append(knext.Column(ktype=knext.double(), name=landmark_column(landmark, "Y")))
+
+    return columns
+
+
+def face_attribute_table(face_details: List[dict], colors: Optional[List[str]], include_confidence: bool = False,
+                         include_pose: bool = False, include_quality: bool = False,
+                         include_landmarks: bool = False, include_bounding_box: bool = False) -> pd.DataFrame:
+    """
+    Build the face attribute table column by column from the FaceDetails of
+    a detect faces response. Every column is extracted into a typed array,
+    the DataFrame is assembled from those arrays without intermediate rows.
+    The Color column is left out if no colors are given.
+    """
+
+    data = {}
+    if colors is not None:
+        data["Color"] = np.array(colors[:len(face_details)], dtype=object)
+    if include_bounding_box:
+        data.update(extract_columns(face_details, BOUNDING_BOX_COLUMNS))
+    data.update(extract_columns(face_details, BASE_COLUMNS))
+
+    emotion_confidences = emotion_matrix(face_details)
+    data["Emotions"] = emotion_labels(emotion_confidences)
+
+    if include_confidence:
+        data.update(extract_columns(face_details, CONFIDENCE_COLUMNS))
+        for index, emotion in enumerate(EMOTION_TYPES):
+            data[emotion_column(emotion)] = emotion_confidences[:, index]
+    if include_pose:
+        data.update(extract_columns(face_details, POSE_COLUMNS))
+    if include_quality:
+        data.update(extract_columns(face_details, QUALITY_COLUMNS))
+    if include_landmarks:
+        landmarks = landmark_matrix(face_details)
+        for index, landmark in enumerate(LANDMARK_TYPES):
+            data[landmark_column(landmark, "X")] = landmarks[:, index, 0]
+            data[landmark_column(landmark, "Y")] = landmarks[:, index, 1]
+
+    return pd.DataFrame(data)
+
+
+def extract_columns(face_details: List[dict], definitions: list) -> dict:
+    """Extract one typed array per column definition"""
+
+    return { name: pd.array([lookup(fd, path) for fd in face_details], dtype=dtype) for (name, _, dtype, path) in definitions }
+
+
+def lookup(face_detail: dict, path: tuple):
+    """Follow a path of keys into a face detail, None if any key is missing"""
+
+    value = face_detail
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def emotion_matrix(face_details: List[dict]) -> np.ndarray:
+    """(faces x emotion types) array of emotion confidences, 0 if not reported"""
+
+    index = { emotion: i for (i, emotion) in enumerate(EMOTION_TYPES) }
+    matrix = np.zeros((len(face_details), len(EMOTION_TYPES)), dtype=np.float64)
+    for row, fd in enumerate(face_details):
+        for emotion in fd.get('Emotions', []):
+            column = index.get(emotion['Type'])
+            if column is not None:
+                matrix[row, column] = emotion['Confidence']
+    return matrix
+
+
+def emotion_labels(confidences: np.ndarray) -> np.ndarray:
+    """Concatenate the emotions above the threshold of each face, most confident first"""
+
+    names = np.array(EMOTION_TYPES, dtype=object)
+    order = np.argsort(-confidences, axis=1, kind="stable")
+    ranked = np.take_along_axis(confidences, order, axis=1) > EMOTION_THRESHOLD
+    labels = np.empty(len(confidences), dtype=object)
+    labels[:] = [", ".join(names[row_order[row_mask]]) for (row_order, row_mask) in zip(order, ranked)]
+    return labels
+
+
+def landmark_matrix(face_details: List[dict]) -> np.ndarray:
+    """(faces x landmark types x 2) array of landmark coordinates, NaN if not reported"""
+
+    index = { landmark: i for (i, landmark) in enumerate(LANDMARK_TYPES) }
+    matrix = np.full((len(face_details), len(LANDMARK_TYPES), 2), np.nan, dtype=np.float64)
+    for row, fd in enumerate(face_details):
+        for landmark in fd.get('Landmarks', []):
+            column = index.get(landmark['Type'])
+            if column is not None:
+                matrix[row, column] = (landmark['X'], landmark['Y'])
+    return matrix
+
+
+def emotion_column(emotion: str) -> str:
+    return "Emotion {0} Confidence".format(emotion.capitalize())
+
+
+def landmark_column(landmark: str, axis: str) -> str:
+    return "Landmark {0} {1}".format(landmark, axis)
@@ -0,0 +1,331 @@
+import glob
+import io
+import logging
+import mmap
+import multiprocessing
+import os
+import threading
+import numpy as np
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image, ImageColor
+from typing import List, Tuple
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+# Named colors used for the first faces of an image. Additional faces get
+# generated colors so the palette never limits the number of faces drawn.
+BASE_COLORS = ["yellow", "blue", "coral", "green", "goldenrod"]
+
+# File extensions picked up when reading all images of a directory
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tif", ".tiff", ".webp"}
+
+# Formats annotated and viewed images can be encoded in, with their MIME types
+OUTPUT_FORMATS = ["JPEG", "WebP", "PNG"]
+MIME_TYPES = {"JPEG": "image/jpeg", "WebP": "image/webp", "PNG": "image/png"}
+
+# PIL's default JPEG quality, kept as default so existing outputs don't change
+DEFAULT_QUALITY = 75
+
+# Stepping the hue by the golden ratio spreads any number of colors evenly
+# around the color wheel while keeping the sequence deterministic.
+GOLDEN_RATIO_CONJUGATE = 0.618033988749895
+
+
+def generate_palette(count: int) -> List[str]:
+    """
+    Generate a deterministic palette of `count` colors. The first colors are
+    the named base colors, the rest are hex strings with golden ratio hues.
+    """
+
+    if count <= len(BASE_COLORS):
+        return BASE_COLORS[:count]
+
+    extra = np.arange(count - len(BASE_COLORS))
+    hues = (0.1 + extra * GOLDEN_RATIO_CONJUGATE) % 1.0
+    # Alternate saturation and value a bit so neighbouring hues stay distinct
+    saturations = np.where(extra % 2 == 0, 0.85, 0.65)
+    values = np.where(extra % 3 == 0, 0.95, 0.80)
+    rgb = (hsv_to_rgb(hues, saturations, values) * 255).round().astype(np.uint8)
+
+    return BASE_COLORS + ["#{0:02x}{1:02x}{2:02x}".format(*channels) for channels in rgb.tolist()]
+
+
+def hsv_to_rgb(h: np.ndarray, s: np.ndarray, v: np.ndarray) -> np.ndarray:
+    """Vectorized HSV to RGB conversion, all components in the range [0, 1]"""
+
+    sector = np.floor(h * 6.0)
+    f = h * 6.0 - sector
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    sector = sector.astype(int) % 6
+
+    conditions = [sector == i for i in range(6)]
+    r = np.select(conditions, [v, q, p, p, t, v])
+    g = np.select(conditions, [t, v, v, q, p, p])
+    b = np.select(conditions, [p, p, t, v, v, q])
+    return np.stack([r, g, b], axis=-1)
+
+
+def bounding_boxes(face_details: List[dict], image_width: int, image_height: int) -> np.ndarray:
+    """
+    Convert the relative bounding boxes of all detected faces into an (N, 4)
+    integer array of pixel coordinates (left, top, right, bottom), clipped
+    to the image bounds.
+    """
+
+    relative = np.array(
+        [[fd['BoundingBox']['Left'], fd['BoundingBox']['Top'], fd['BoundingBox']['Width'], fd['BoundingBox']['Height']] for fd in face_details],
+        dtype=np.float64
+    ).reshape(-1, 4)
+
+    scale = np.array([image_width, image_height, image_width, image_height], dtype=np.float64)
+    left_top = relative[:, :2] * scale[:2]
+    right_bottom = left_top + relative[:, 2:] * scale[2:]
+    boxes = np.concatenate([left_top, right_bottom], axis=1)
+
+    upper = np.array([image_width - 1, image_height - 1, image_width - 1, image_height - 1], dtype=np.float64)
+    return np.clip(boxes, 0, upper).round().astype(np.int64)
+
+
+def edge_rectangles(boxes: np.ndarray, line_width: int) -> np.ndarray:
+    """
+    Split the outline of every box into its top, bottom, left and right
+    bands, as a (4N, 4) array of inclusive pixel rectangles (left, top,
+    right, bottom). Bands grow inward like PIL outlines and stay inside
+    their box, the bands of a box follow each other.
+    """
+
+    left, top, right, bottom = boxes.T
+    width = np.minimum(line_width, np.minimum(right - left, bottom - top) + 1)
+    bands = np.stack([
+        np.stack([left, top, right, top + width - 1], axis=1),
+        np.stack([left, bottom - width + 1, right, bottom], axis=1),
+        np.stack([left, top, left + width - 1, bottom], axis=1),
+        np.stack([right - width + 1, top, right, bottom], axis=1),
+    ], axis=1)
+    return bands.reshape(-1, 4)
+
+
+def draw_boxes(image: Image.Image, boxes: np.ndarray, colors: List[str], line_width: int = 4) -> Image.Image:
+    """
+    Draw the outlines of all bounding boxes onto an RGB image. The pixel
+    coordinates of all outlines are computed as arrays and written with a
+    single indexed assignment, so there is no drawing call per box. Later
+    boxes are drawn over earlier ones. Returns the annotated image.
+    """
+
+    if len(boxes) == 0:
+        return image
+
+    rectangles = edge_rectangles(boxes, line_width)
+    fills = np.repeat(np.array([ImageColor.getrgb(color)[:3] for color in colors[:len(boxes)]], dtype=np.uint8), 4, axis=0)
+
+    # enumerate the pixels of every rectangle row by row from a flat offset
+    widths = rectangles[:, 2] - rectangles[:, 0] + 1
+    sizes = widths * (rectangles[:, 3] - rectangles[:, 1] + 1)
+    rectangle_ids = np.repeat(np.arange(len(rectangles)), sizes)
+    offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    xs = rectangles[rectangle_ids, 0] + offsets % widths[rectangle_ids]
+    ys = rectangles[rectangle_ids, 1] + offsets // widths[rectangle_ids]
+
+    pixels = np.array(image)
+    pixels[ys, xs] = fills[rectangle_ids]
+    return Image.fromarray(pixels)
+
+
+def downscale(image: Image.Image, max_size: int) -> Image.Image:
+    """Downscale an opened image in place so its larger side is at most `max_size` pixels, 0 keeps its size"""
+
+    if max_size > 0:
+        # Lets the JPEG decoder skip detail instead of decoding the full image
+        image.draft("RGB", (max_size, max_size))
+        image.thumbnail((max_size, max_size))
+    return image
+
+
+def open_image(image_bytes: bytes, max_size: int = 0) -> Image.Image:
+    """Open an image, downscaled to at most `max_size` pixels if a maximum is given"""
+
+    return downscale(Image.open(io.BytesIO(image_bytes)), max_size)
+
+
+def encode_image(image: Image.Image, output_format: str = "JPEG", quality: int = DEFAULT_QUALITY) -> bytes:
+    """Encode an image as JPEG, WebP or PNG. The quality applies to JPEG and WebP, PNG is lossless."""
+
+    pil_format = output_format.upper()
+    if pil_format == "JPEG" and image.mode != "RGB":
+        image = image.convert("RGB")
+    elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+    buffer = io.BytesIO()
+    if pil_format == "PNG":
+        image.save(buffer, format=pil_format)
+    else:
+        image.save(buffer, format=pil_format, quality=quality)
+    return buffer.getvalue()
+
+
+def annotate_image(image_bytes: bytes, face_details: List[dict], colors: List[str],
+                   output_format: str = "JPEG", quality: int = DEFAULT_QUALITY, max_size: int = 0) -> bytes:
+    """
+    Draw the bounding boxes of the detected faces onto an image and encode
+    it. Thumbnails are downscaled before drawing, so boxes keep their width.
+    """
+
+    image = open_image(image_bytes, max_size)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image_width, image_height = image.size
+
+    boxes = bounding_boxes(face_details, image_width, image_height)
+    image = draw_boxes(image, boxes, colors)
+    return encode_image(image, output_format, quality)
+
+
+def pool_context():
+    """
+    Start method of the worker processes. Forking the node process while its
+    network threads run can deadlock the children, so the workers are forked
+    from a fresh fork server where available and spawned otherwise.
+    """
+
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+class RenderPipeline:
+    """
+    Annotate images in a pool of worker processes while the caller keeps
+    producing them, so drawing and encoding don't hold up the threads
+    waiting on the network. At most `max_pending` images are queued, a
+    submit blocks until a slot is free, which bounds the memory used. With
+    a single process, or if the pool can't be started or breaks, images are
+    annotated in the calling process instead.
+    """
+
+    def __init__(self, processes: int = 0, max_pending: int = 0,
+                 output_format: str = "JPEG", quality: int = DEFAULT_QUALITY, max_size: int = 0):
+        self.encoding = (output_format, quality, max_size)
+        self.processes = processes if processes > 0 else (os.cpu_count() or 1)
+        self.slots = threading.BoundedSemaphore(max_pending if max_pending > 0 else 2 * self.processes)
+        self.executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=pool_context()) if self.processes > 1 else None
+        # key, future and the inputs of the image, kept until it is annotated to redo it if a worker dies
+        self.pending: List[list] = []
+
+    def submit(self, key, image_bytes: bytes, face_details: List[dict], colors: List[str]):
+        """Queue an image for annotation under a key, blocking while the queue is full"""
+
+        self.slots.acquire()
+        future = None
+        if self.executor is not None:
+            try:
+                future = self.executor.submit(annotate_image, image_bytes, face_details, colors, *self.encoding)
+            except (BrokenProcessPool, OSError, RuntimeError) as err:
+                LOGGER.warning("annotating images in the node process, the worker processes failed: {0}".format(err))
+                self.executor.shutdown(wait=False)
+                self.executor = None
+        if future is None:
+            future = Future()
+            try:
+                future.set_result(annotate_image(image_bytes, face_details, colors, *self.encoding))
+            except Exception as err:
+                future.set_exception(err)
+        entry = [key, future, (image_bytes, face_details, colors)]
+        self.pending.append(entry)
+        future.add_done_callback(lambda done: self.done(entry, done))
+
+    def done(self, entry: list, future: Future):
+        if not future.cancelled() and future.exception() is None:
+            entry[2] = None
+        self.slots.release()
+
+    def results(self) -> List[tuple]:
+        """
+        Wait for all queued images, returning (key, annotated image) in
+        submission order. Images lost with a crashed worker, for example one
+        killed for running out of memory, are annotated in the node process.
+        Images that can't be annotated, such as undecodable files, are
+        returned as None so the other images are kept.
+        """
+
+        rendered = []
+        for key, future, inputs in self.pending:
+            try:
+                try:
+                    rendered.append((key, future.result()))
+                except BrokenProcessPool as err:
+                    if self.executor is not None:
+                        LOGGER.warning("annotating the remaining images in the node process, a worker process died: {0}".format(err))
+                        self.executor.shutdown(wait=False)
+                        self.executor = None
+                    rendered.append((key, annotate_image(*inputs, *self.encoding)))
+            except Exception as err:
+                LOGGER.error("unable to annotate the image of {0}: {1}".format(key, err))
+                rendered.append((key, None))
+        return rendered
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=exc_info[0] is not None)
+
+
+def read_image_file(path: str, target_format: str = "JPEG", max_size: int = 0) -> Tuple[bytes, str]:
+    """
+    Read an image file for passing it on as binary data. The file is memory
+    mapped and only its header is decoded; if it already has the target
+    format and needs no resizing its bytes are returned as they are. Other
+    files are converted, JPEG files decode at reduced scale when a maximum
+    size is given. Other formats such as TIFF and PNG are fully decoded
+    before downscaling, their memory use grows with the image size.
+    Returns the image bytes and the format of the file.
+    """
+
+    if os.path.getsize(path) == 0:
+        raise ValueError("Image file is empty: {0}".format(path))
+
+    with open(path, "rb") as image_file, mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        image = Image.open(mapped)
+        source_format = image.format
+        if source_format == target_format and (max_size <= 0 or max(image.size) <= max_size):
+            return mapped[:], source_format
+        return convert_image(image, target_format, max_size), source_format
+
+
+def convert_image(image: Image.Image, target_format: str = "JPEG", max_size: int = 0) -> bytes:
+    """
+    Convert an opened image into the target format, downscaling it so its
+    larger side is at most `max_size` pixels if a maximum is given. Only
+    JPEG decodes at reduced scale, which bounds its memory; other formats
+    are decoded in full first.
+    """
+
+    image = downscale(image, max_size)
+    if target_format == "JPEG" and image.mode != "RGB":
+        image = image.convert("RGB")
+
+    buffer = io.BytesIO()
+    image.save(buffer, format=target_format)
+    return buffer.getvalue()
+
+
+def list_image_files(path_or_pattern: str) -> List[str]:
+    """
+    Resolve a directory, a glob pattern or a single file into a sorted list
+    of image files. Directories are searched for files with image extensions.
+    """
+
+    if os.path.isdir(path_or_pattern):
+        paths = [ os.path.join(path_or_pattern, name) for name in os.listdir(path_or_pattern) ]
+        paths = [ path for path in paths if os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS ]
+    else:
+        paths = glob.glob(path_or_pattern, recursive=True)
+
+    return sorted(path for path in paths if os.path.isfile(path))
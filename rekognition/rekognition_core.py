@@ -0,0 +1,307 @@
+import hashlib
+import json
+import logging
+import threading
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from os.path import exists
+from typing import Callable, List, Optional, Tuple
+
+import boto3
+import knime_extension as knext
+import numpy as np
+import pandas as pd
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+import aws_auth
+import aws_metrics
+import face_attributes
+from video_detection import parse_s3_uri
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Column definitions as (column name, KNIME type, pandas dtype, path into a result item),
+# in the same format as the face attribute columns.
+LABEL_COLUMNS = [
+    ("Label", knext.string(), object, ("Name",)),
+    ("Confidence", knext.double(), "float64", ("Confidence",)),
+]
+
+TEXT_COLUMNS = [
+    ("Detected Text", knext.string(), object, ("DetectedText",)),
+    ("Type", knext.string(), object, ("Type",)),
+    ("ID", knext.int64(), "Int64", ("Id",)),
+    ("Parent ID", knext.int64(), "Int64", ("ParentId",)),
+    ("Confidence", knext.double(), "float64", ("Confidence",)),
+    ("Box Left", knext.double(), "float64", ("Geometry", "BoundingBox", "Left")),
+    ("Box Top", knext.double(), "float64", ("Geometry", "BoundingBox", "Top")),
+    ("Box Width", knext.double(), "float64", ("Geometry", "BoundingBox", "Width")),
+    ("Box Height", knext.double(), "float64", ("Geometry", "BoundingBox", "Height")),
+]
+
+FACE_MATCH_COLUMNS = [
+    ("Face ID", knext.string(), object, ("Face", "FaceId")),
+    ("External Image ID", knext.string(), object, ("Face", "ExternalImageId")),
+    ("Similarity", knext.double(), "float64", ("Similarity",)),
+    ("Face Confidence", knext.double(), "float64", ("Face", "Confidence")),
+]
+
+FACE_RECORD_COLUMNS = [
+    ("Face ID", knext.string(), object, ("Face", "FaceId")),
+    ("Image ID", knext.string(), object, ("Face", "ImageId")),
+    ("External Image ID", knext.string(), object, ("Face", "ExternalImageId")),
+    ("Face Confidence", knext.double(), "float64", ("Face", "Confidence")),
+    ("Box Left", knext.double(), "float64", ("Face", "BoundingBox", "Left")),
+    ("Box Top", knext.double(), "float64", ("Face", "BoundingBox", "Top")),
+    ("Box Width", knext.double(), "float64", ("Face", "BoundingBox", "Width")),
+    ("Box Height", knext.double(), "float64", ("Face", "BoundingBox", "Height")),
+]
+
+# Column referencing the input row each output row belongs to
+SOURCE_ROW_COLUMN = knext.Column(ktype=knext.string(), name="Source Row")
+
+
+def create_client(auth_input, region: str = "", max_workers: int = 10, service: str = "rekognition", node: str = ""):
+    """
+    Create a client for the given AWS credentials. The connection pool is
+    sized for the number of concurrent workers and throttled calls are
+    retried with the adaptive retry mode, which also rate limits the client.
+    This is the only retry layer, the batch executor does not retry calls.
+    The calls are recorded in the metrics under the name of the node.
+    """
+
+    access_key, secret = aws_auth.decode_basic_auth(auth_input)
+    session = boto3.Session(aws_access_key_id=access_key, aws_secret_access_key=secret)
+    config = Config(max_pool_connections=max(10, max_workers), retries={'max_attempts': 10, 'mode': 'adaptive'})
+    client = aws_metrics.instrument(session.client(service, region_name=region if region else None, config=config), node)
+    _sessions[client] = (session, config)
+    return client
+
+
+# Session and config of the clients created with create_client, to create clients of other services with the same credentials
+_sessions = weakref.WeakKeyDictionary()
+
+
+def companion_client(client, service: str):
+    """Client of another service with the credentials, region and config of a client created with create_client"""
+
+    session, config = _sessions[client]
+    return aws_metrics.instrument(session.client(service, region_name=client.meta.region_name, config=config), aws_metrics.node_of(client))
+
+
+def load_image(value) -> Tuple[str, dict, Optional[bytes]]:
+    """
+    Decode a cell of an image column into the Image parameter of a
+    Rekognition call. Cells can hold the image bytes, an s3://bucket/key
+    URI or the path of a local image file. Returns a key identifying the
+    image content, the Image parameter and the image bytes if available.
+    S3 objects are identified by their URI, see `BatchExecutor.content_key`.
+    """
+
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        image_bytes = bytes(value)
+    elif isinstance(value, str) and value.startswith("s3://"):
+        bucket, key = parse_s3_uri(value)
+        return value, {'S3Object': {'Bucket': bucket, 'Name': key}}, None
+    elif isinstance(value, str) and exists(value):
+        with open(value, "rb") as image_file:
+            image_bytes = image_file.read()
+    else:
+        raise ValueError("Cell is neither image data, an S3 URI nor an existing file: {0}".format(str(value)[:100]))
+
+    return hashlib.sha256(image_bytes).hexdigest(), {'Bytes': image_bytes}, image_bytes
+
+
+class BatchResult:
+    """Outcome of one Rekognition call for one input row"""
+
+    def __init__(self, row_key: str, response: Optional[dict] = None, error: Optional[Exception] = None, image_bytes: Optional[bytes] = None):
+        self.row_key = row_key
+        self.response = response
+        self.error = error
+        self.image_bytes = image_bytes
+
+    @property
+    def error_code(self) -> Optional[str]:
+        if isinstance(self.error, ClientError):
+            return self.error.response['Error']['Code']
+        return None
+
+
+class BatchExecutor:
+    """
+    Run one Rekognition operation for every row of a table with a pool of
+    worker threads sharing one client. With the cache enabled, rows with the
+    same image content and parameters share one call, also while the call is
+    still in flight: the first row calls the operation and the other rows
+    wait for its response. Images are identified by the SHA-256 of their
+    bytes and S3 objects by their ETag.
+    """
+
+    def __init__(self, client, operation: str, max_workers: int = 10, use_cache: bool = True, keep_image_bytes: bool = False):
+        self.client = client
+        self.operation = operation
+        self.max_workers = max(1, max_workers)
+        self.use_cache = use_cache
+        self.keep_image_bytes = keep_image_bytes
+        self.lock = threading.Lock()
+        self.responses = {}
+        self.etags = {}
+        self.s3_client = None
+        self.calls = 0
+
+    def run(self, row_keys: List[str], values: list, params: Callable[[int], dict] = lambda index: {},
+            progress: Callable[[int, int], None] = lambda done, total: None,
+            is_canceled: Callable[[], bool] = lambda: False,
+            on_result: Callable[[int, BatchResult], None] = lambda index, result: None) -> List[BatchResult]:
+        """
+        Call the operation for every cell in `values`, with the per row
+        parameters returned by `params`. Results are returned in input order
+        and handed to `on_result` with their index as each call completes,
+        while the remaining calls continue.
+        """
+
+        total = len(values)
+        results = [None] * total
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = { executor.submit(self.call, row_keys[index], values[index], params(index), is_canceled): index for index in range(total) }
+            for done, future in enumerate(as_completed(futures)):
+                index = futures[future]
+                results[index] = future.result()
+                on_result(index, results[index])
+                progress(done + 1, total)
+        return results
+
+    def call(self, row_key: str, value, row_params: dict, is_canceled: Callable[[], bool]) -> BatchResult:
+        """Load the image of one row and call the operation for it"""
+
+        if is_canceled():
+            return BatchResult(row_key, error=RuntimeError("Execution canceled"))
+
+        try:
+            image_key, image, image_bytes = load_image(value)
+            if self.use_cache:
+                cache_key = "{0}|{1}".format(self.content_key(image_key, image), json.dumps(row_params, sort_keys=True, default=str))
+                response = self.shared(self.responses, cache_key, lambda: self.invoke(image, row_params))
+            else:
+                response = self.invoke(image, row_params)
+            return BatchResult(row_key, response=response, image_bytes=image_bytes if self.keep_image_bytes else None)
+        except Exception as err:
+            if isinstance(err, ClientError):
+                LOGGER.error("error invoking {0}: {1}; code: {2}".format(self.operation, err.response['Error']['Message'], err.response['Error']['Code']))
+            else:
+                LOGGER.error("error invoking {0} for row {1}: {2}".format(self.operation, row_key, err))
+            return BatchResult(row_key, error=err)
+
+
+    def shared(self, table: dict, key: str, compute: Callable[[], object]):
+        """
+        Return the value of `compute` for a key, computing it only once per
+        run. Concurrent callers of the same key wait for the first one. A
+        failure is raised in all waiting callers and forgotten afterwards,
+        so a later row with the same key tries again.
+        """
+
+        with self.lock:
+            future = table.get(key)
+            owner = future is None
+            if owner:
+                future = table[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            future.set_result(compute())
+        except Exception as err:
+            with self.lock:
+                del table[key]
+            future.set_exception(err)
+        return future.result()
+
+    def content_key(self, image_key: str, image: dict) -> str:
+        """
+        Key of the image content. S3 objects are looked up once per URI and
+        identified by their ETag, so copies of an object under other keys
+        share one call. Falls back to the URI if the object can't be read.
+        """
+
+        if 'S3Object' not in image:
+            return image_key
+
+        def etag() -> str:
+            try:
+                with self.lock:
+                    if self.s3_client is None:
+                        self.s3_client = companion_client(self.client, "s3")
+                head = self.s3_client.head_object(Bucket=image['S3Object']['Bucket'], Key=image['S3Object']['Name'])
+                return "etag:{0}".format(head['ETag'].strip('"'))
+            except Exception as err:
+                LOGGER.debug("using the URI as key of {0}: {1}".format(image_key, err))
+                return image_key
+
+        return self.shared(self.etags, image_key, etag)
+
+    def invoke(self, image: dict, row_params: dict) -> dict:
+        """Call the operation, throttling and service errors are retried by the client"""
+
+        with self.lock:
+            self.calls += 1
+        return getattr(self.client, self.operation)(Image=image, **row_params)
+
+
+def collect_items(results: List[BatchResult], items_key: str) -> Tuple[List[str], List[dict]]:
+    """Flatten the result items of all successful rows, with the source row of each item"""
+
+    source_rows = []
+    items = []
+    for result in results:
+        if result.response is None:
+            continue
+        row_items = result.response.get(items_key, [])
+        source_rows.extend([result.row_key] * len(row_items))
+        items.extend(row_items)
+    return source_rows, items
+
+
+def item_table(source_rows: List[str], items: List[dict], definitions: list) -> pd.DataFrame:
+    """Build a table from result items column by column, prefixed with the source row"""
+
+    data = {SOURCE_ROW_COLUMN.name: np.array(source_rows, dtype=object)}
+    data.update(face_attributes.extract_columns(items, definitions))
+    return pd.DataFrame(data)
+
+
+def item_columns(definitions: list) -> List[knext.Column]:
+    """Columns of a table built with `item_table`"""
+
+    return [SOURCE_ROW_COLUMN] + [knext.Column(ktype=ktype, name=name) for (name, ktype, _, _) in definitions]
+
+
+def report_errors(exec_context: knext.ExecutionContext, results: List[BatchResult]):
+    """Set a node warning summarizing the rows that failed"""
+
+    failed = [ result for result in results if result.error is not None ]
+    if len(failed) > 0:
+        codes = sorted({ result.error_code or type(result.error).__name__ for result in failed })
+        exec_context.set_warning("{0} of {1} rows failed ({2}), see the log for details".format(len(failed), len(results), ", ".join(codes)))
+
+
+def run_batch(exec_context: knext.ExecutionContext, client, operation: str, input_pd: pd.DataFrame, image_column: str,
+              max_workers: int, use_cache: bool, params: Callable[[int], dict] = lambda index: {},
+              keep_image_bytes: bool = False,
+              on_result: Callable[[int, BatchResult], None] = lambda index, result: None) -> List[BatchResult]:
+    """Run an operation for every row of the input table, reporting progress and failed rows on the node"""
+
+    row_keys = [ str(key) for key in input_pd.index ]
+    values = input_pd[image_column].tolist()
+    executor = BatchExecutor(client, operation, max_workers, use_cache, keep_image_bytes)
+
+    def progress(done: int, total: int):
+        exec_context.set_progress(done / total, "Processed {0} of {1} images".format(done, total))
+
+    results = executor.run(row_keys, values, params, progress, exec_context.is_canceled, on_result)
+    LOGGER.info("{0} calls of {1} for {2} rows".format(executor.calls, operation, len(results)))
+    report_errors(exec_context, results)
+    return results
@@ -0,0 +1,124 @@
+import hashlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import aws_metrics
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Number of faces requested per page of get_face_detection results (the service maximum)
+PAGE_SIZE = 1000
+
+# Upper bound for the wait between two status checks of a job
+MAX_POLL_INTERVAL = 30.0
+
+
+class VideoJobError(Exception):
+    """Raised when a face detection job on a stored video does not succeed"""
+
+
+def parse_s3_uri(uri: str) -> Tuple[str, str]:
+    """Split an s3://bucket/key URI into bucket and key"""
+
+    if not isinstance(uri, str) or not uri.startswith("s3://"):
+        raise ValueError("Not an S3 URI: {0}".format(uri))
+    bucket, _, key = uri[len("s3://"):].partition("/")
+    if len(bucket) == 0 or len(key) == 0:
+        raise ValueError("S3 URI needs a bucket and a key: {0}".format(uri))
+    return bucket, key
+
+
+def start_face_detection(client, video_uri: str, face_attributes: str = "ALL") -> str:
+    """
+    Start an asynchronous face detection job for a video stored in S3.
+    The request token is derived from the URI so a retried start call
+    returns the job that is already running instead of starting a new one.
+    """
+
+    bucket, key = parse_s3_uri(video_uri)
+    token = hashlib.sha256("{0}|{1}".format(video_uri, face_attributes).encode("utf-8")).hexdigest()[:64]
+    response = client.start_face_detection(
+        Video={'S3Object': {'Bucket': bucket, 'Name': key}},
+        FaceAttributes=face_attributes,
+        ClientRequestToken=token
+    )
+    return response['JobId']
+
+
+def wait_for_job(client, job_id: str, poll_interval: float, is_canceled: Callable[[], bool] = lambda: False) -> dict:
+    """
+    Poll a face detection job until it is no longer in progress, backing off
+    between polls. Returns the first page of results of the finished job.
+    """
+
+    interval = poll_interval
+    started = time.time()
+    while True:
+        response = client.get_face_detection(JobId=job_id, MaxResults=PAGE_SIZE)
+        status = response['JobStatus']
+        if status != 'IN_PROGRESS':
+            aws_metrics.record_wait(aws_metrics.node_of(client), "GetFaceDetection", client.meta.region_name, time.time() - started)
+        if status == 'SUCCEEDED':
+            return response
+        if status == 'FAILED':
+            raise VideoJobError("Face detection job {0} failed: {1}".format(job_id, response.get('StatusMessage', '')))
+        if is_canceled():
+            raise VideoJobError("Face detection job {0} canceled while waiting".format(job_id))
+
+        time.sleep(interval)
+        interval = min(interval * 1.5, MAX_POLL_INTERVAL)
+
+
+def iter_faces(client, job_id: str, first_page: dict) -> Iterator[Tuple[int, dict]]:
+    """Page through the results of a finished job, yielding (timestamp, face detail) pairs"""
+
+    page = first_page
+    while True:
+        for face in page.get('Faces', []):
+            yield face['Timestamp'], face['Face']
+
+        next_token = page.get('NextToken')
+        if not next_token:
+            return
+        page = client.get_face_detection(JobId=job_id, MaxResults=PAGE_SIZE, NextToken=next_token)
+
+
+def detect_faces_in_video(client, video_uri: str, poll_interval: float, is_canceled: Callable[[], bool] = lambda: False) -> Tuple[str, List[int], List[dict]]:
+    """Run one face detection job from start to the last page of results"""
+
+    job_id = start_face_detection(client, video_uri)
+    LOGGER.info("Started face detection job {0} for {1}".format(job_id, video_uri))
+
+    first_page = wait_for_job(client, job_id, poll_interval, is_canceled)
+    timestamps = []
+    face_details = []
+    for timestamp, face_detail in iter_faces(client, job_id, first_page):
+        timestamps.append(timestamp)
+        face_details.append(face_detail)
+
+    LOGGER.info("Face detection job {0} found {1} faces".format(job_id, len(face_details)))
+    return job_id, timestamps, face_details
+
+
+def detect_faces_in_videos(client, video_uris: List[str], max_jobs: int, poll_interval: float,
+                           is_canceled: Callable[[], bool] = lambda: False) -> Iterator[Tuple[str, Optional[str], List[int], List[dict], Optional[Exception]]]:
+    """
+    Run face detection jobs for many videos concurrently, at most `max_jobs`
+    at a time. Results are yielded as (video, job id, timestamps, face details,
+    error) tuples in the order the jobs finish so callers can consume them
+    while other jobs are still running.
+    """
+
+    with ThreadPoolExecutor(max_workers=max(1, max_jobs)) as executor:
+        futures = { executor.submit(detect_faces_in_video, client, uri, poll_interval, is_canceled): uri for uri in dict.fromkeys(video_uris) }
+        for future in as_completed(futures):
+            uri = futures[future]
+            try:
+                job_id, timestamps, face_details = future.result()
+                yield uri, job_id, timestamps, face_details, None
+            except Exception as err:
+                LOGGER.error("Face detection failed for {0}: {1}".format(uri, err))
+                yield uri, None, [], [], err